@@ -1,3 +1,4 @@
+import os
 import time
 import dash
 from dash import Dash, dcc, html
@@ -7,11 +8,13 @@ import dash_loading_spinners
 from dash.exceptions import PreventUpdate
 from dash.dependencies import Input, Output, State
 
-from model.Updater import ParquetUpdater
-
 
 # cache the data in /parquet.
-ParquetUpdater()
+# With PS_DASH_MODE=web the app only reads the cached data. It is then produced
+# by a separate worker process started with: python -m model.Updater --worker
+if os.environ.get('PS_DASH_MODE', 'standalone') != 'web':
+    from model.Updater import ParquetUpdater
+    ParquetUpdater()
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css', dbc.themes.BOOTSTRAP, dbc.icons.BOOTSTRAP]
 
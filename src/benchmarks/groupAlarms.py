@@ -0,0 +1,81 @@
+# Compares the per-site alarm counting used for alarmsGrouped.parquet before and after
+# vectorizing it, on synthetic data of the size of the production cache.
+# Run from src/: python -m benchmarks.groupAlarms [number of sites]
+import io
+import sys
+import time
+import random
+
+import numpy as np
+import pandas as pd
+
+from model.Alarms import Alarms
+
+
+EVENTS = ['bad owd measurements', 'large clock correction', 'path changed between sites',
+          'destination cannot be reached from multiple', 'destination cannot be reached from any',
+          'source cannot reach any', 'firewall issue', 'bandwidth decreased from/to multiple sites',
+          'bandwidth decreased', 'bandwidth increased from/to multiple sites', 'bandwidth increased',
+          'high packet loss', 'high packet loss on multiple links', 'complete packet loss', 'path changed']
+
+
+# the implementation before the vectorization
+def loopCount(nodes, pivotFrames, dateFrom, dateTo):
+    alarmCnt = []
+    for site, lat, lon in nodes[['site', 'lat', 'lon']].drop_duplicates().values.tolist():
+        for e, df in pivotFrames.items():
+            sdf = df[(df['tag'] == site) & ((df['to'] >= dateFrom) & (df['to'] <= dateTo))]
+            if len(sdf) > 0:
+                entry = {"event": e, "site": site, 'cnt':  len(sdf['id'].unique()),
+                         "lat": lat, "lon": lon}
+            else:
+                entry = {"event": e, "site": site, 'cnt': 0,
+                         "lat": lat, "lon": lon}
+            alarmCnt.append(entry)
+
+    return pd.DataFrame(alarmCnt)
+
+
+def syntheticData(nSites, rowsPerEvent):
+    rng = random.Random(0)
+    sites = [f'SITE-{i}' for i in range(nSites)]
+    nodes = pd.DataFrame({'site': sites,
+                          'lat': [str(round(rng.uniform(-90, 90), 4)) for _ in sites],
+                          'lon': [str(round(rng.uniform(-180, 180), 4)) for _ in sites]})
+
+    days = pd.date_range('2024-01-01', '2024-03-01', freq='min').strftime('%Y-%m-%d %H:%M:%S.000Z').tolist()
+    pivotFrames = {}
+    for e in EVENTS:
+        ids = np.sort(np.random.default_rng(len(e)).integers(0, rowsPerEvent // 3, rowsPerEvent))
+        pivotFrames[e] = pd.DataFrame({
+            'from': [rng.choice(days) for _ in ids],
+            'to': [rng.choice(days) for _ in ids],
+            'tag': [rng.choice(sites + ['']) for _ in ids],
+            'id': ids,
+        })
+    return nodes, pivotFrames
+
+
+def toParquet(df):
+    buffer = io.BytesIO()
+    df.to_parquet(buffer)
+    return buffer.getvalue()
+
+
+if __name__ == '__main__':
+    nSites = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    nodes, pivotFrames = syntheticData(nSites, rowsPerEvent=20000)
+    dateFrom, dateTo = '2024-02-28 00:00:00.000Z', '2024-02-29 00:00:00.000Z'
+
+    start = time.perf_counter()
+    before = loopCount(nodes, pivotFrames, dateFrom, dateTo)
+    loopTime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    after = Alarms.countAlarmsPerSite(nodes, pivotFrames, dateFrom, dateTo)
+    vectorizedTime = time.perf_counter() - start
+
+    print(f'{nSites} sites, {len(EVENTS)} events, {sum(len(df) for df in pivotFrames.values())} pivot rows')
+    print(f'loop:       {loopTime:.3f} secs')
+    print(f'vectorized: {vectorizedTime:.3f} secs ({loopTime/vectorizedTime:.0f}x faster)')
+    print('identical parquet output:', toParquet(before) == toParquet(after))
@@ -0,0 +1,52 @@
+# Writes measure partitions the way ParquetUpdater.cacheIndexData stores them
+# (raw/measures/idx=<index>/window=<ms>.parquet, each with an "idx" column) into a
+# temporary snapshot and reads them back through Parquet.readSequenceOfFiles, like the site page.
+# Run from src/: python -m benchmarks.measuresRoundTrip
+import sys
+import shutil
+import tempfile
+
+import pandas as pd
+
+from utils.parquet import Parquet
+
+
+INDICES = {'ps_packetloss': 48*60*1000, 'ps_owd': 48*60*1000, 'ps_throughput': 12*60*60*1000}
+
+
+# the columns of qrs.query4Avg, for a few pairs in one window
+def window(idx, start, size):
+    pairs = [('10.0.0.1', '10.0.0.2', 'SITE-A', 'SITE-B'), ('10.0.0.3', '10.0.0.4', 'SITE-C', 'SITE-D')]
+    df = pd.DataFrame([{'pair': f'{src}-{dest}', 'src': src, 'dest': dest, 'src_host': src, 'dest_host': dest,
+                        'src_site': srcSite, 'dest_site': destSite, 'value': 1.5, 'from': start,
+                        'to': start + size, 'doc_count': 10} for src, dest, srcSite, destSite in pairs])
+    df['idx'] = idx
+    return df
+
+
+def main(windows=3):
+    root = tempfile.mkdtemp()
+    try:
+        snap = Parquet(f'{root}/')
+        written = 0
+        for idx, size in INDICES.items():
+            for i in range(windows):
+                df = window(idx, i * size, size)
+                snap.writeToFile(df, f'raw/measures/idx={idx}/window={i * size}.parquet')
+                written += len(df)
+
+        measures = snap.readSequenceOfFiles('raw/measures/', 'idx=*/window=')
+        if measures is None:
+            print('The measures could not be read back')
+            return 1
+
+        counts = measures['idx'].value_counts().to_dict()
+        expected = {idx: written // len(INDICES) for idx in INDICES}
+        print(f'{len(measures)} of {written} rows read back, per index: {counts}')
+        return 0 if counts == expected else 1
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main(*[int(a) for a in sys.argv[1:2]]))
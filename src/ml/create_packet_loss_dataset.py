@@ -6,14 +6,9 @@ from utils.helpers import timer
 
 @timer
 def loadPacketLossData(dateFrom, dateTo):
-    data = []
-    intv = int(hp.CalcMinutes4Period(dateFrom, dateTo) / 60)
-    time_list = hp.GetTimeRanges(dateFrom, dateTo, intv)
-    for i in range(len(time_list) - 1):
-        print(f' {i+1}/{len(time_list)-1} packetloss query', time_list[i], time_list[i + 1])
-        data.extend(qrs.query4Avg('ps_packetloss', time_list[i], time_list[i + 1]))
-
-    return pd.DataFrame(data)
+    # the hourly averages of all pairs are returned by a single time-binned query
+    dateFrom, dateTo = hp.GetTimeRanges(dateFrom, dateTo)
+    return qrs.query4Avg('ps_packetloss', dateFrom, dateTo, binSize=60*60*1000)
 
 
 def getPercentageMeasuresDone(df, dateFrom, dateTo):
@@ -72,7 +67,4 @@ def createPcktDataset(dateFrom, dateTo):
     plsDf = markPairs(dateFrom, dateTo)
     plsDf = plsDf[plsDf['tests_done'] != '0%']
 
-    plsDf['src_site'] = plsDf['src_site'].str.upper()
-    plsDf['dest_site'] = plsDf['dest_site'].str.upper()
-
     return plsDf
\ No newline at end of file
@@ -0,0 +1,154 @@
+import threading
+import traceback
+from collections import OrderedDict
+
+import pandas as pd
+
+from utils.parquet import Parquet
+import model.queries as qrs
+
+
+# Local copy of the ps_asns index: asn -> owner
+FILE = 'raw/asnOwners.parquet'
+# max number of owners kept in memory
+CACHE_SIZE = 20000
+# max number of ASNs requested from ES at once
+BATCH_SIZE = 500
+
+
+# The owners are looked up in the following order:
+#   1. an in-memory LRU cache
+#   2. the table stored in the current snapshot, refreshed on a schedule by the updater
+#   3. ES, for the ASNs not in the table yet. By default the ASNs are requested
+#      in batches by a background thread and the caller gets the known owners right away
+class ASNOwners(object):
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        # ASNs waiting for the background lookup
+        self.queue = set()
+        self.fetcher = None
+        # owners found in ES since the table was last written, only kept
+        # when an updater runs in the process to write them (see flush)
+        self.discovered = {}
+        self.keepDiscovered = False
+
+    # Returns {asn: owner} for the ASNs with a known owner.
+    # wait=True looks up the unknown ones in ES before returning,
+    # cache=False skips the cached ES responses (see qrs.getASNInfo)
+    def get(self, asns, wait=False, cache=True):
+        asns = {str(a) for a in asns}
+        owners = self.fromCache(asns)
+
+        missing = asns - owners.keys()
+        if missing:
+            owners.update(self.fromTable(missing))
+            missing = asns - owners.keys()
+
+        if missing:
+            if wait:
+                owners.update(self.fetch(missing, cache))
+            else:
+                self.schedule(missing)
+
+        return {asn: owner for asn, owner in owners.items() if owner is not None}
+
+    # None marks an ASN not found in ES, so that it is not requested again
+    def fromCache(self, asns):
+        owners = {}
+        with self.lock:
+            for asn in asns:
+                if asn in self.cache:
+                    self.cache.move_to_end(asn)
+                    owners[asn] = self.cache[asn]
+        return owners
+
+    def remember(self, owners):
+        with self.lock:
+            for asn, owner in owners.items():
+                self.cache[asn] = owner
+                self.cache.move_to_end(asn)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+
+    def fromTable(self, asns):
+        try:
+            df = pd.read_parquet(Parquet().path(FILE), filters=[('asn', 'in', list(asns))])
+        except FileNotFoundError:
+            return {}
+        except Exception:
+            print(traceback.format_exc())
+            return {}
+
+        owners = dict(zip(df['asn'], df['owner']))
+        self.remember(owners)
+        return owners
+
+    def fetch(self, asns, cache=True):
+        asns = list(asns)
+        found = {}
+        for i in range(0, len(asns), BATCH_SIZE):
+            batch = asns[i:i+BATCH_SIZE]
+            owners = qrs.getASNInfo(batch, cache=cache)
+            found.update(owners)
+            self.remember({asn: owners.get(asn) for asn in batch})
+
+        if self.keepDiscovered:
+            with self.lock:
+                self.discovered.update(found)
+        return found
+
+    def schedule(self, asns):
+        with self.lock:
+            self.queue |= asns
+            if self.fetcher is None:
+                self.fetcher = threading.Thread(target=self._drain, name='ASNOwners', daemon=True)
+                self.fetcher.start()
+
+    def _drain(self):
+        while True:
+            with self.lock:
+                if not self.queue:
+                    self.fetcher = None
+                    return
+                batch = set(list(self.queue)[:BATCH_SIZE])
+                self.queue -= batch
+            try:
+                self.fetch(batch)
+            except Exception:
+                print(traceback.format_exc())
+
+    # Writes the full ps_asns index into a snapshot being published
+    def store(self, snap):
+        owners = qrs.getASNInfo(cache=False)
+        with self.lock:
+            owners.update(self.discovered)
+            self.discovered = {}
+        self.writeTable(snap, owners)
+        return len(owners)
+
+    # Adds the owners found in ES since the last write to the table of a snapshot being published
+    def flush(self, snap):
+        with self.lock:
+            discovered, self.discovered = self.discovered, {}
+        if not discovered:
+            return
+
+        try:
+            owners = pd.read_parquet(snap.path(FILE))
+            owners = dict(zip(owners['asn'], owners['owner']))
+        except FileNotFoundError:
+            owners = {}
+        owners.update(discovered)
+        self.writeTable(snap, owners)
+
+    @staticmethod
+    def writeTable(snap, owners):
+        df = pd.DataFrame({'asn': list(owners.keys()), 'owner': list(owners.values())})
+        snap.writeToFile(df.sort_values('asn').reset_index(drop=True), FILE)
+
+
+# shared by the pages and the updater of a process
+asnOwners = ASNOwners()
@@ -1,7 +1,10 @@
-import glob
 import os
+import threading
+import weakref
 from elasticsearch.helpers import scan
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 import traceback
 from flask import request
 
@@ -14,14 +17,254 @@ import urllib3
 urllib3.disable_warnings()
 
 
+# Arrow types of the alarm fields, the rest of the fields are inferred.
+# The site names repeat in millions of rows, so they are dictionary-encoded
+# (categorical in pandas). The dates stay ISO strings, all readers compare them as such
+SITE = pa.dictionary(pa.int32(), pa.string())
+SITES = pa.list_(pa.string())
+VALUES = pa.list_(pa.float64())
+FIELD_TYPES = {
+  'from': pa.string(),
+  'to': pa.string(),
+  'created_at': pa.int64(),
+  'id': pa.int64(),
+  'site': SITE,
+  'src_site': SITE,
+  'dest_site': SITE,
+  'tag': SITES,
+  'sites': SITES,
+  'src_sites': SITES,
+  'dest_sites': SITES,
+  'cannotBeReachedFrom': SITES,
+  'hosts': SITES,
+  'dest_loss%': VALUES,
+  'src_loss%': VALUES,
+  'dest_change': VALUES,
+  'src_change': VALUES,
+  'diff': pa.list_(pa.int64()),
+}
+# a row of an unfolded pivot frame refers to a single site and value
+PIVOT_TYPES = {**FIELD_TYPES,
+  'tag': SITE,
+  'dest_loss%': pa.float64(),
+  'src_loss%': pa.float64(),
+  'dest_change': pa.float64(),
+  'src_change': pa.float64(),
+}
+
+
+# The positions of the rows holding each site in a pivot frame sorted by "to", per site column,
+# and of each (src_site, dest_site) pair, as sorted integer arrays. Within a period the rows
+# of a site are found with a binary search, instead of comparing the whole column
+class SiteIndex(object):
+
+  COLUMNS = ['tag', 'src_site', 'dest_site']
+  EMPTY = np.array([], dtype=np.int64)
+
+  # sites=False keeps only the times, for the frames which are not looked up by site
+  def __init__(self, df, sites=True):
+    # the searches on a numpy array are O(log n), unlike the ones on arrow strings
+    to = df['to'].iloc[:df['to'].notna().sum()]
+    self.to = to.to_numpy() if pd.api.types.is_numeric_dtype(to) else to.to_numpy(dtype=object)
+    self.rows = {}
+    for col in self.COLUMNS if sites else []:
+      # some events keep a list of sites in "tag", those are not indexed
+      if col in df.columns and self.holdsSites(df[col]):
+        self.rows[col] = self.group(df[col])
+    if 'src_site' in self.rows and 'dest_site' in self.rows:
+      self.rows['pair'] = self.group(pd.MultiIndex.from_arrays([df['src_site'], df['dest_site']]))
+
+  @staticmethod
+  def holdsSites(values):
+    values = values.dropna()
+    return len(values) == 0 or isinstance(values.iloc[0], str)
+
+  # value -> positions of the rows holding it, in ascending order
+  @classmethod
+  def group(cls, values):
+    codes, uniques = pd.factorize(values)
+    order = np.argsort(codes, kind='stable')[(codes < 0).sum():]
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    return dict(zip(uniques.tolist(), np.split(order.astype(np.int64), np.cumsum(counts)[:-1])))
+
+  # the first and end positions of the rows with "to" between dateFrom and dateTo (inclusive)
+  def period(self, dateFrom=None, dateTo=None):
+    lo = 0 if dateFrom is None else np.searchsorted(self.to, dateFrom, side='left')
+    hi = len(self.to) if dateTo is None else np.searchsorted(self.to, dateTo, side='right')
+    return lo, hi
+
+  # the positions of the rows with any of the values in column, between the positions lo and hi
+  def find(self, column, values, lo, hi):
+    rows = self.rows[column]
+    found = [rows.get(v, self.EMPTY) for v in values]
+    pos = found[0] if len(found) == 1 else np.unique(np.concatenate(found + [self.EMPTY]))
+    return pos[np.searchsorted(pos, lo):np.searchsorted(pos, hi)]
+
+
+# The frames read by Alarms.loadData are kept in memory and read again only when their file changed.
+# The files of a snapshot are hard links to the ones of the previous snapshot unless they were
+# rewritten, so the inode and mtime of a file identify the version of its data across snapshots.
+# The index of a pivot frame is built along with it, so there is one per version of the file
+class FrameCache(object):
+
+  def __init__(self):
+    # name -> (version, frame)
+    self.files = {}
+    # id of a frame (or a slice of it) given out -> (SiteIndex, first row, end row in the cached frame)
+    self.indexed = {}
+    # (snapshot folder, versions of the pivot files, AlarmTable)
+    self.alarmTable = None
+    self.lock = threading.Lock()
+
+  def get(self, pq, name):
+    try:
+      st = os.stat(pq.path(name))
+    except FileNotFoundError:
+      return None
+    version = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    with self.lock:
+      entry = self.files.get(name)
+    if entry is not None and entry[0] == version:
+      return entry[1]
+
+    df = pq.readFile(name)
+    if df is None:
+      return None
+    # sorted by "to", so that any period is a contiguous slice of the frame
+    if 'to' in df.columns:
+      df = df.sort_values('to', kind='stable', na_position='last')
+      self.register(df, SiteIndex(df, sites=name.startswith('pivot/')), 0, len(df))
+
+    with self.lock:
+      self.files[name] = (version, df)
+    return df
+
+  def register(self, df, index, lo, hi):
+    key = id(df)
+    self.indexed[key] = (index, lo, hi)
+    weakref.finalize(df, self.indexed.pop, key, None)
+
+  # The AlarmTable of the pivot frames of the snapshot, built again when one of them changed
+  def table(self, pq):
+    # a published snapshot does not change
+    root = pq.root()
+    current = self.alarmTable
+    if current is not None and current[0] == root:
+      return current[2]
+
+    pivotFrames = {name: self.get(pq, name) for name in pq.glob('pivot/*')}
+    with self.lock:
+      key = tuple((name, self.files[name][0]) for name in pivotFrames if name in self.files)
+    if current is not None and current[1] == key:
+      table = current[2]
+    else:
+      table = AlarmTable({Alarms.eventUF(os.path.basename(name)): df for name, df in pivotFrames.items()
+                          if df is not None and 'to' in df.columns})
+    self.alarmTable = (root, key, table)
+    return table
+
+  # whether the frames are the ones (or slices of the ones) given out by the cache
+  def cached(self, frames):
+    return len(frames) > 0 and all(id(df) in self.indexed for df in frames)
+
+  # The rows with "to" between dateFrom and dateTo (inclusive), as a slice of the cached frame.
+  # The frames are shared by all callers, they must not be changed in place
+  def between(self, df, dateFrom, dateTo):
+    index, start, end = self.indexed.get(id(df)) or (SiteIndex(df, sites=False), 0, len(df))
+    lo, hi = index.period(dateFrom, dateTo)
+    lo, hi = max(lo, start), min(hi, end)
+    sliced = df.iloc[lo - start:max(lo, hi) - start]
+    self.register(sliced, index, lo, max(lo, hi))
+    return sliced
+
+  # The positions in df of the rows matching values (see Alarms.select),
+  # None when df is not indexed or a column cannot be looked up
+  def lookup(self, df, dateFrom, dateTo, values):
+    entry = self.indexed.get(id(df))
+    if entry is None:
+      return None
+    index, start, end = entry
+    lo, hi = index.period(dateFrom, dateTo)
+    lo, hi = max(lo, start), min(hi, end)
+
+    values = dict(values)
+    if isinstance(values.get('src_site'), str) and isinstance(values.get('dest_site'), str) and 'pair' in index.rows:
+      values['pair'] = (values.pop('src_site'), values.pop('dest_site'))
+    if any(col not in index.rows for col in values):
+      return None
+
+    pos = None
+    for col, v in values.items():
+      found = index.find(col, v if isinstance(v, list) else [v], lo, hi)
+      pos = found if pos is None else np.intersect1d(pos, found, assume_unique=True)
+    if pos is None:
+      pos = np.arange(lo, max(lo, hi), dtype=np.int64)
+    return pos - start
+
+
+frameCache = FrameCache()
+
+
+# The sites and ids of all pivot frames in one table, sorted by "to" with the event as a
+# categorical. The alarms of all events in a period are a contiguous slice of it, found like
+# the ones of a single frame (see SiteIndex.period), and the ones of a site through its SiteIndex
+class AlarmTable(object):
+
+  COLUMNS = ['id', 'tag', 'src_site', 'dest_site']
+
+  def __init__(self, pivotFrames):
+    parts = []
+    for event, pdf in pivotFrames.items():
+      part = pd.DataFrame({'event': event, 'to': pdf['to'].to_numpy(dtype=object)})
+      for col in self.COLUMNS:
+        if col in pdf.columns and (col == 'id' or SiteIndex.holdsSites(pdf[col])):
+          part[col] = pdf[col].values if col == 'id' else pdf[col].astype(object).values
+      parts.append(part)
+
+    df = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame({'event': [], 'to': []})
+    df = df.reindex(columns=['event', 'to'] + self.COLUMNS)
+    df = df[df['to'].notna()].sort_values('to', kind='stable').reset_index(drop=True)
+    df['event'] = pd.Categorical(df['event'], categories=list(pivotFrames.keys()))
+    for col in ['tag', 'src_site', 'dest_site']:
+      df[col] = df[col].astype('category')
+
+    self.df = df
+    self.events = list(pivotFrames.keys())
+    # the events without a source and destination site, those are matched by "tag" only
+    self.siteEvents = [e for e, pdf in pivotFrames.items() if 'src_site' not in pdf.columns or 'dest_site' not in pdf.columns]
+    frameCache.register(df, SiteIndex(df), 0, len(df))
+
+  # the rows of the period matching the values, see Alarms.select
+  def select(self, dateFrom, dateTo, **values):
+    return Alarms.select(self.df, dateFrom, dateTo, **values)
+
+  # the number of distinct alarms of each event in rows (other than exclude)
+  def countAlarms(self, rows, exclude=None):
+    events = rows['event'].cat.codes.to_numpy().astype(np.int64)
+    ids = rows['id'].to_numpy().astype(np.int64)
+    keep = events != (self.events.index(exclude) if exclude in self.events else -1)
+    # one key per (event, id)
+    span = int(ids.max()) + 1 if len(ids) else 1
+    alarms = np.unique(events[keep] * span + ids[keep])
+    counts = np.bincount(alarms // span, minlength=len(self.events))
+    return {event: int(n) for event, n in zip(self.events, counts) if n > 0}
+
+
 class Alarms(object):
 
+  # the events unfolded to one row per site in the pivot frames
+  ONE2MANY_EVENTS = {'destination cannot be reached from multiple': 'cannotBeReachedFrom', 'firewall issue': 'sites'}
+  BOTH_WAYS_EVENTS = ['high packet loss on multiple links', 'bandwidth increased from/to multiple sites',
+                      'bandwidth decreased from/to multiple sites']
+  TAG_EVENTS = ['high packet loss', 'path changed', 'destination cannot be reached from any', 'source cannot reach any',
+                'bandwidth decreased', 'bandwidth increased', 'complete packet loss', 'path changed between sites']
+
+  # one row per tag, the tag column is moved to the end
   @staticmethod
   def list2rows(df):
-      s = df.apply(lambda x: pd.Series(x['tag']), axis=1).stack().reset_index(level=1, drop=True)
-      s.name = 'tag'
-      df = df.drop('tag', axis=1).join(s)
-      return df
+      df = df.explode('tag')
+      return df[[c for c in df.columns if c != 'tag'] + ['tag']]
   
 
   def unpackAlarms(self, alarmsData):
@@ -35,22 +278,15 @@ class Alarms(object):
           df['id'] = df.index
           frames[event] = df
 
-          if event == 'destination cannot be reached from multiple':
-            df = self.one2manyUnfold(odf=df,
-                                    fld='site',
-                                    fldNewName='dest_site',
-                                    listSites='cannotBeReachedFrom',
-                                    listedNewName='src_site')
-            df['tag'] = df['site']
-          elif event == 'firewall issue':
+          if event in self.ONE2MANY_EVENTS:
             df = self.one2manyUnfold(odf=df,
                                      fld='site',
                                      fldNewName='dest_site',
-                                     listSites='sites',
+                                     listSites=self.ONE2MANY_EVENTS[event],
                                      listedNewName='src_site')
             df['tag'] = df['site']
 
-          elif event in ['high packet loss on multiple links', 'bandwidth increased from/to multiple sites', 'bandwidth decreased from/to multiple sites']:
+          elif event in self.BOTH_WAYS_EVENTS:
             df = self.oneInBothWaysUnfold(df)
 
           elif event == 'large clock correction':
@@ -60,16 +296,7 @@ class Alarms(object):
             df = df.round(2)
             # df['tags'] = df['tag']
 
-          elif event in ['high packet loss',
-                         'path changed',
-                         'destination cannot be reached from any',
-                         'source cannot reach any',
-                         'bandwidth decreased',
-                         'bandwidth increased',
-                         'complete packet loss',
-                         'path changed between sites']:
-            
-            
+          elif event in self.TAG_EVENTS:
             df = self.list2rows(df)
 
     
@@ -83,6 +310,52 @@ class Alarms(object):
 
 
 
+  # The schema the frame (or pivot frame) of an event is stored with
+  @classmethod
+  def schema(cls, event, df, pivot=False):
+    unfolded = event in cls.ONE2MANY_EVENTS or event in cls.BOTH_WAYS_EVENTS or event in cls.TAG_EVENTS
+    # the site of a clock correction is picked from the tags of the alarm itself
+    types = PIVOT_TYPES if (pivot and unfolded) or event == 'large clock correction' else FIELD_TYPES
+
+    # a field missing from all alarms keeps the inferred (null or float) type
+    def fieldType(f):
+      if f.name in types and f.name in df.columns and df[f.name].notna().any():
+        return types[f.name]
+      return f.type
+
+    inferred = pa.Schema.from_pandas(df, preserve_index=True)
+    return pa.schema([pa.field(f.name, fieldType(f)) for f in inferred], metadata=inferred.metadata)
+
+
+  # Counts the alarms of each event for every site (0 when there are none).
+  # Column "to" is closest to the time the alarm was generated, thus it has to be
+  # between dateFrom and dateTo.
+  @staticmethod
+  def countAlarmsPerSite(nodes, pivotFrames, dateFrom, dateTo):
+    sites = nodes[['site', 'lat', 'lon']].drop_duplicates()
+    siteNames = set(sites['site'])
+
+    recent = []
+    for e, df in pivotFrames.items():
+      sdf = df[(df['to'] >= dateFrom) & (df['to'] <= dateTo)]
+      # some events keep a list of sites in "tag", those never match a single site
+      sdf = sdf[sdf['tag'].astype(object).map(lambda t: isinstance(t, str) and t in siteNames)]
+      recent.append(pd.DataFrame({'event': e, 'site': sdf['tag'].values, 'id': sdf['id'].values}))
+
+    if len(recent) == 0:
+      return pd.DataFrame()
+
+    # the number of unique alarms for the given site. Those are the documents generated and stored in ES,
+    # which can be found in the frames folder, while pivotFrames expands the alarms to the level of individual sites
+    cnt = pd.concat(recent).groupby(['site', 'event'], observed=True)['id'].nunique().rename('cnt').reset_index()
+
+    alarmCnt = sites.merge(pd.DataFrame({'event': list(pivotFrames.keys())}), how='cross')
+    alarmCnt = alarmCnt.merge(cnt, on=['site', 'event'], how='left')
+    alarmCnt['cnt'] = alarmCnt['cnt'].fillna(0).astype(int)
+
+    return alarmCnt[['event', 'site', 'cnt', 'lat', 'lon']]
+
+
   # code friendly event name
   @staticmethod
   def eventCF(event):
@@ -95,85 +368,81 @@ class Alarms(object):
     return event.replace('_', ' ').replace('-', '/')
 
 
+  # one row per site listed in listSites, the list itself is kept
   @staticmethod
   def one2manyUnfold(odf, fld, fldNewName, listSites, listedNewName):
-      s = odf.apply(lambda x: pd.Series(x[listSites]), axis=1).stack(
-      ).reset_index(level=1, drop=True)
-      s.name = listedNewName
-      odf = odf.join(s)
+      s = odf[listSites].explode()
+      odf = odf.loc[s.index]
+      odf[listedNewName] = s.values
       odf[fldNewName] = odf[fld]
       return odf
 
 
+  # One row for each of the dest_sites (site -> dest_site) followed by one row for each
+  # of the src_sites (src_site -> site) of an alarm, along with the value of that link
   @staticmethod
   def oneInBothWaysUnfold(odf):
-    data = []
     # the field name changed on the DB side
     if 'dest_loss%' in odf.columns and 'src_loss%' in odf.columns:
       odf['dest_loss%'] = odf['dest_loss%'].fillna(odf['dest_loss'])
       odf['src_loss%'] = odf['src_loss%'].fillna(odf['src_loss'])
       odf.drop(columns=['dest_loss', 'src_loss'], inplace=True)
 
-    for r in odf.to_dict('records'):
-      for i, dest_site in enumerate(r['dest_sites']):
-        rec = {
-          'from': r['from'],
-          'to': r['to'],
-          'dest_site': dest_site,
-          'src_site': r['site'],
-          'id': r['id'],
-          'tag': r['tag'][0]
-        }
-        if 'dest_loss%' in r.keys():
-          rec['dest_loss%'] = r['dest_loss%'][i]
-        elif 'dest_change' in r.keys():
-          rec['dest_change'] = r['dest_change'][i]
-
-        if 'ipv6' in r.keys():
-          rec['ipv6'] = r['ipv6']
-          
-        data.append(rec)
-
-      for i, src_site in enumerate(r['src_sites']):
-        rec = {
-          'from': r['from'],
-          'to': r['to'],
-          'src_site': src_site,
-          'dest_site': r['site'],
-          'id': r['id'],
-          'tag': r['tag'][0]
-        }
-        if 'src_loss%' in r.keys():
-          rec['src_loss%'] = r['src_loss%'][i]
-        elif 'src_change' in r.keys():
-          rec['src_change'] = r['src_change'][i]
-
-        if 'ipv6' in r.keys():
-          rec['ipv6'] = r['ipv6']
-
-        data.append(rec)
-
-    df = pd.DataFrame(data)
+    def unfold(sites, siteName, otherName, values):
+      values = [v for v in values if v in odf.columns][:1]
+      df = odf[odf[sites].str.len() > 0]
+      df = df[['from', 'to', sites, 'site', 'id', 'tag'] + values + (['ipv6'] if 'ipv6' in odf.columns else [])]
+      # the values are listed in the same order as the sites
+      df = df.explode([sites] + values)
+      df = df.rename(columns={sites: siteName, 'site': otherName})
+      df['tag'] = df['tag'].str[0]
+      return df
 
-    return df
+    dest = unfold('dest_sites', 'dest_site', 'src_site', ['dest_loss%', 'dest_change'])
+    src = unfold('src_sites', 'src_site', 'dest_site', ['src_loss%', 'src_change'])
+
+    # the original index keeps the rows of an alarm together, the stable sort keeps their order
+    df = pd.concat([dest, src]).sort_index(kind='stable').reset_index(drop=True)
+
+    return df.infer_objects()
 
 
-  def getAllAlarms(self, dateFrom, dateTo):
-    data = qrs.queryAlarms(dateFrom, dateTo)
+  def getAllAlarms(self, dateFrom, dateTo, watermarks=None):
+    data = qrs.queryAlarms(dateFrom, dateTo, watermarks)
     if 'indexing' in data.keys(): del data['indexing']
     frames, pivotFrames = self.unpackAlarms(data)
     return [frames, pivotFrames]
 
 
+  # The rows of a pivot frame having the given value (or one of a list of values) in each column,
+  # e.g. select(pdf, tag=site) or select(pdf, dateFrom, dateTo, src_site=src, dest_site=dest),
+  # with "to" between dateFrom and dateTo when those are given. The frames returned
+  # by loadData are looked up in their SiteIndex, any other frame is scanned
+  @staticmethod
+  def select(pdf, dateFrom=None, dateTo=None, **values):
+    pos = frameCache.lookup(pdf, dateFrom, dateTo, values)
+    if pos is not None:
+      return pdf.iloc[pos]
+
+    mask = np.ones(len(pdf), dtype=bool)
+    if dateFrom is not None:
+      mask &= (pdf['to'] >= dateFrom).values
+    if dateTo is not None:
+      mask &= (pdf['to'] <= dateTo).values
+    for col, v in values.items():
+      mask &= (pdf[col].isin(v) if isinstance(v, list) else pdf[col] == v).values
+    return pdf[mask]
+
+
   # Check the requested period and either read the data
-  # from the local files or read from ES
+  # from the local files (see FrameCache) or read from ES
   def loadData(self, dateFrom, dateTo):
     print(f"loadData for {dateFrom}, {dateTo}")
     print('+++++++++++++++++++++')
     print()
 
     pq = Parquet()
-    folder = glob.glob("parquet/frames/*")
+    folder = pq.glob("frames/*")
     isTooOld = False
     frames, pivotFrames = {}, {}
     try:
@@ -183,16 +452,14 @@ class Alarms(object):
         for f in folder:
             event = os.path.basename(f)
             event = self.eventUF(event)
-            df = pq.readFile(f)
+            df = frameCache.get(pq, f)
 
             if 'from' in df.columns.tolist():
 
-              if dateFrom >= df[~df['from'].isnull()]['from'].min():
-                  frames[event] = df[(df['to']>=dateFrom) & (df['to'] <= dateTo)]
-                  pdf = pq.readFile(f"parquet/pivot/{os.path.basename(f)}")
-
-                  pdf = pdf[(pdf['to'] >= dateFrom) & (pdf['to'] <= dateTo)]
-                  pivotFrames[event] = pdf
+              if dateFrom >= df['from'].min():
+                  frames[event] = frameCache.between(df, dateFrom, dateTo)
+                  pdf = frameCache.get(pq, f"pivot/{os.path.basename(f)}")
+                  pivotFrames[event] = frameCache.between(pdf, dateFrom, dateTo)
 
               else:
                   isTooOld = True
@@ -230,26 +497,26 @@ class Alarms(object):
     # print(dateFrom, dateTo, currEvent, alarmEnd, '# alarms:', [len(d) for d in pivotFrames], site, src_site, dest_site)
     print()
 
+    # the frames of the snapshot are all looked up at once, in its AlarmTable
+    if frameCache.cached(list(pivotFrames.values())):
+      return self.countOtherAlarms(frameCache.table(Parquet()), currEvent, dateFrom, dateTo, site, src_site, dest_site)
+
     alarmsListed = {}
 
     for event, pdf in pivotFrames.items():
       if not event == currEvent:
         try:
-          subdf = pdf[(pdf['to'] >= dateFrom) & (pdf['to'] <= dateTo)]
-
           if src_site is not None and dest_site is not None and 'src_site' in pdf.columns and 'dest_site' in pdf.columns:
             src_site, dest_site = src_site.upper(), dest_site.upper()
-            if len(subdf[(subdf['src_site'] == src_site) & (subdf['dest_site'] == dest_site)]) > 0:
-                subdf = subdf[(subdf['src_site'] == src_site) & (subdf['dest_site'] == dest_site)]
+            subdf = self.select(pdf, dateFrom, dateTo, src_site=src_site, dest_site=dest_site)
+            if len(subdf) > 0:
                 alarmsListed[event] = len(subdf['id'].unique())
 
           elif site is not None:
             site = site.upper()
-            if len(subdf[subdf['tag'] == site]) > 0:
-              subdf = subdf[((subdf['tag'] == site))]
-
-              if len(subdf) > 0:
-                  alarmsListed[event] = len(subdf['id'].unique())
+            subdf = self.select(pdf, dateFrom, dateTo, tag=site)
+            if len(subdf) > 0:
+                alarmsListed[event] = len(subdf['id'].unique())
 
         except Exception as e:
             print(f'Issue with {event}')
@@ -258,6 +525,23 @@ class Alarms(object):
     return alarmsListed
 
 
+  # the number of alarms of each event (other than currEvent) in the period, for the pair or the site
+  @staticmethod
+  def countOtherAlarms(table, currEvent, dateFrom, dateTo, site=None, src_site=None, dest_site=None):
+    rows = []
+    if src_site is not None and dest_site is not None:
+      rows.append(table.select(dateFrom, dateTo, src_site=src_site.upper(), dest_site=dest_site.upper()))
+      if site is not None:
+        bySite = table.select(dateFrom, dateTo, tag=site.upper())
+        rows.append(bySite[bySite['event'].isin(table.siteEvents)])
+    elif site is not None:
+      rows.append(table.select(dateFrom, dateTo, tag=site.upper()))
+
+    if not rows:
+      return {}
+    return table.countAlarms(pd.concat(rows) if len(rows) > 1 else rows[0], exclude=currEvent)
+
+
   @staticmethod
   def list2str(vals, sign):
     values = vals.values
@@ -325,6 +609,8 @@ class Alarms(object):
            df.drop('%change', axis=1, inplace=True)
         if 'id' in df.columns:
             df.drop('id', axis=1, inplace=True)
+        if 'created_at' in df.columns:
+            df.drop('created_at', axis=1, inplace=True)
         if 'avg_value' in df.columns:
             df['avg_value'] = df['avg_value'].apply(lambda x: f'{x}%')
         if 'alarm_id' in df.columns:
@@ -367,9 +653,11 @@ class Alarms(object):
   
   @staticmethod
   @timer
-  # The code uses the description from ES and replaces the variables with the values
-  def buildSummary(alarm):
-    description = qrs.getCategory(alarm['event'])['template']
+  # The code uses the description from ES and replaces the variables with the values.
+  # The category can be passed when it was already queried
+  def buildSummary(alarm, category=None):
+    category = category or qrs.getCategory(alarm['event'])
+    description = category['template']
     description = description.split('More')[0]
     words = description.split()
 
@@ -1,15 +1,20 @@
 import os
 import os.path
+import argparse
 import time
+import random
 import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from utils.parquet import Parquet
 from model.Alarms import Alarms
+from model.ASNOwners import asnOwners
 import utils.helpers as hp
 from utils.helpers import timer
 import model.queries as qrs
 import pandas as pd
+import pyarrow as pa
 import pickle
 
 from ml.create_thrpt_dataset import createThrptDataset
@@ -20,6 +25,27 @@ from ml.packet_loss_train_model import packet_loss_train_model
 import os
 from datetime import datetime, timedelta
 
+
+# Bounds for the concurrent window queries sent to ES.
+# MAX_WORKERS caps the in-flight queries for the whole updater,
+# MAX_WORKERS_PER_INDEX caps them for a single index
+MAX_WORKERS = 8
+MAX_WORKERS_PER_INDEX = 4
+esSlots = threading.BoundedSemaphore(MAX_WORKERS)
+
+# The measures are cached as one partition per index and time window:
+# parquet/raw/measures/idx=<index>/window=<epoch millis of the window start>.parquet
+# 'window' is the partition size in ms, 'retention' is in days
+MEASURES = {
+    'ps_packetloss': {'window': 48*60*1000, 'retention': 1},
+    'ps_owd': {'window': 48*60*1000, 'retention': 1},
+    'ps_throughput': {'window': 12*60*60*1000, 'retention': 21},  # 12 hour bins
+}
+# the last complete windows are queried again on every run, even if they are stored,
+# for the measurements indexed in ES after the window was first fetched
+GRACE_WINDOWS = 3
+
+
 @timer
 class ParquetUpdater(object):
     
@@ -27,120 +53,157 @@ class ParquetUpdater(object):
         self.pq = Parquet()
         self.location = 'parquet/'
         self.createLocation(self.location)
+        # large files prepared before being published in a snapshot
+        self.staging = Parquet(f'{self.location}staging/')
+        # the owners found by the pages of this process are added to the table by the updater
+        asnOwners.keepDiscovered = True
+
+        # Each job produces one artifact recorded in the manifest of the snapshot.
+        # (function, artifact, interval between runs, max age of the artifact on start) in seconds
+        jobs = [
+            (self.storeMetaData, 'metaDf', int(60*60*12), 60*60*25),
+            (self.cacheIndexData, 'measures', 60*60, 60*60*2),
+            (self.storeAlarms, 'alarms', 60*10, 60*60),
+            (self.storeASNOwners, 'asnOwners', int(60*60*12), 60*60*25),
+            (self.storePathChangeDescDf, 'prev_next_asn', 60*30, 60*60),
+            # Store the data for the Major Alarms analysis
+            (self.storeThroughputDataAndModel, 'throughput_model', int(60*60*12), 60*60*25),
+            (self.storePacketLossDataAndModel, 'packet_loss_model', int(60*60*12), 60*60*25),
+        ]
 
-        folders = ['raw', 'frames', 'pivot', 'ml-datasets'] 
-        for folder in folders:
-            self.createLocation(self.location + folder + '/')
+        schedulers = [(Scheduler(interval, function), artifact, maxAge)
+                      for function, artifact, interval, maxAge in jobs]
 
-        # Prevent the data from being updated if it is fresh
-        if self.__isDataFresh(self.location) == False:
-            print("Data is too old or folders are empty. Updating...")
-            self.storeMetaData()
-            self.cacheIndexData()
-            self.storeAlarms()
-            self.storePathChangeDescDf()
-            self.storeThroughputDataAndModel()
-            self.storePacketLossDataAndModel()
-
-        try:
-            Scheduler(60*60, self.cacheIndexData)
-            Scheduler(60*10, self.storeAlarms)
-            Scheduler(60*30, self.storePathChangeDescDf)
-            Scheduler(int(60*60*12), self.storeMetaData)
-
-            # Store the data for the Major Alarms analysis
-            Scheduler(int(60*60*12), self.storeThroughputDataAndModel)
-            Scheduler(int(60*60*12), self.storePacketLossDataAndModel)
-        except Exception as e:
-            print(traceback.format_exc())
+        # Refresh only the artifacts that are missing or too old, e.g. after
+        # a restart only the jobs that did not complete recently are run
+        for job, artifact, maxAge in schedulers:
+            if self.pq.isStale(artifact, maxAge):
+                print(f"{artifact} is missing or older than {maxAge/3600}h. Updating...")
+                job.run()
 
 
     # The following function is used to group alarms by site 
     # taking into account the most recent 24 hours only
-    def groupAlarms(self, pivotFrames):
+    def groupAlarms(self, pivotFrames, snap):
         dateFrom, dateTo = hp.defaultTimeRange(1)
-        metaDf = self.pq.readFile('parquet/raw/metaDf.parquet')
+        metaDf = snap.readFile('raw/metaDf.parquet')
 
         nodes = metaDf[~(metaDf['site'].isnull()) & ~(
             metaDf['site'] == '') & ~(metaDf['lat'] == '') & ~(metaDf['lat'].isnull())]
-        alarmCnt = []
-
-        for site, lat, lon in nodes[['site', 'lat', 'lon']].drop_duplicates().values.tolist():
-            for e, df in pivotFrames.items():
-                # column "to" is closest to the time the alarms was generated, 
-                # thus we want to which approx. when the alarms was created,
-                # to be between dateFrom and dateTo
-
-                sdf = df[(df['tag'] == site) & ((df['to'] >= dateFrom) & (df['to'] <= dateTo))]
-                if len(sdf) > 0:
-                    # sdf['id'].unique() returns the number of unique alarms for the given site
-                    # those are the documents generated and stored in ES. They can be found in frames folder
-                    # While pivotFrames expands the alarms to the level of individual sites
-                    entry = {"event": e, "site": site, 'cnt':  len(sdf['id'].unique()),
-                            "lat": lat, "lon": lon}
-                else:
-                    entry = {"event": e, "site": site, 'cnt': 0,
-                            "lat": lat, "lon": lon}
-                alarmCnt.append(entry)
 
-        alarmsGrouped = pd.DataFrame(alarmCnt)
+        alarmsGrouped = Alarms.countAlarmsPerSite(nodes, pivotFrames, dateFrom, dateTo)
+
+        snap.writeToFile(alarmsGrouped, 'alarmsGrouped.parquet')
 
-        self.pq.writeToFile(alarmsGrouped, f'{self.location}alarmsGrouped.parquet')
+
+    @staticmethod
+    def queryWindows(idx, windows):
+        # the global semaphore keeps the total number of in-flight queries
+        # bounded when several indices are fetched at the same time
+        with esSlots:
+            return qrs.query4Avg(idx, windows[0][0], windows[-1][1], binSize=MEASURES[idx]['window'])
 
 
     @staticmethod
-    def __isDataFresh(folder_path):
-        total_size = 0
-        twenty_five_hours_ago = datetime.now() - timedelta(hours=25)
+    def measureWindows(idx, stored):
+        # The windows are aligned to multiples of their size since epoch,
+        # so that every run produces the same boundaries. The complete windows
+        # within the retention which are not stored yet are returned, along with
+        # the last GRACE_WINDOWS ones
+        size = MEASURES[idx]['window']
+        now = int(hp.now()*1000)
+        retentionStart = (now - MEASURES[idx]['retention']*24*60*60*1000) // size * size
+        lastComplete = now // size * size - size
+        graceStart = lastComplete - (GRACE_WINDOWS - 1) * size
 
-        if os.path.exists(folder_path):
-            for path, dirs, files in os.walk(folder_path):
-                if not dirs and not files:
-                    return False
+        stored = set(stored)
+        return [(w, w + size) for w in range(retentionStart, lastComplete + 1, size)
+                if w not in stored or w >= graceStart], retentionStart
 
-                for file in files:
-                    file_path = os.path.join(path, file)
-                    file_date_created = datetime.fromtimestamp(os.path.getctime(file_path))
-                    total_size += os.path.getsize(file_path)
 
-                    if total_size <= 10 or file_date_created <= twenty_five_hours_ago:
-                        return False
+    def storedWindows(self, folder):
+        windows = []
+        for f in self.pq.glob(f'{folder}window=*.parquet'):
+            windows.append(int(os.path.basename(f)[len('window='):-len('.parquet')]))
+        return sorted(windows)
 
-        return True
+
+    @staticmethod
+    def windowChunks(windows):
+        # The windows are split in runs of consecutive windows, so that the windows already
+        # stored between them are not queried, and the runs in chunks of up to
+        # len(windows) / MAX_WORKERS_PER_INDEX windows
+        runs = []
+        for w in windows:
+            if runs and runs[-1][-1][1] == w[0]:
+                runs[-1].append(w)
+            else:
+                runs.append([w])
+        perChunk = -(-len(windows) // MAX_WORKERS_PER_INDEX)
+        return [run[i:i+perChunk] for run in runs for i in range(0, len(run), perChunk)]
+
+
+    def queryData(self, idx, windows):
+        # The chunks of windows are fetched in parallel, up to MAX_WORKERS_PER_INDEX at once.
+        # Each chunk is a single time-binned query where the bins are the windows
+        if not windows:
+            return
+        chunks = self.windowChunks(windows)
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS_PER_INDEX) as pool:
+            # map() yields the results in the order of the chunks
+            for chunk, data in zip(chunks, pool.map(lambda c: self.queryWindows(idx, c), chunks)):
+                byWindow = dict(list(data.groupby('from')))
+                for dateFrom, dateTo in chunk:
+                    yield dateFrom, byWindow.get(dateFrom, data.iloc[:0])
 
 
     @timer
-    def queryData(self, idx, dateFrom, dateTo):
-        intv = int(hp.CalcMinutes4Period(dateFrom, dateTo)/30)
-        if idx in ['ps_throughput']:
-            dateFrom, dateTo = hp.defaultTimeRange(21)
-            intv = 42  # 12 hour bins
+    def updateMeasures(self, idx, location):
+        folder = f'{location}idx={idx}/'
 
-        data = []
-        
-        time_list = hp.GetTimeRanges(dateFrom, dateTo, intv)
-        for i in range(len(time_list)-1):
-            data.extend(qrs.query4Avg(idx, time_list[i], time_list[i+1]))
+        stored = self.storedWindows(folder)
+        windows, retentionStart = self.measureWindows(idx, stored)
+        print(f'{idx}: {len(windows)} windows to fetch')
 
-        return data
+        partitions = {}
+        try:
+            for window, data in self.queryData(idx, windows):
+                # empty windows are not stored (a stored window queried again in the grace
+                # period is kept) and are queried again on the next runs, until they leave
+                # the retention, in case the data arrived late
+                if len(data) > 0:
+                    df = data.reset_index(drop=True)
+                    df['idx'] = idx
+                    partitions[f'{folder}window={window}.parquet'] = df
+        except Exception as e:
+            # the windows are collected in order, so a failed window
+            # and the ones after it are retried on the next run
+            print(f'Failed to fetch {idx}:', e)
+            print(traceback.format_exc())
+
+        expired = [f'{folder}window={window}.parquet' for window in stored if window < retentionStart]
+        return partitions, expired
 
 
     @timer
     def cacheIndexData(self):
-        location = 'parquet/raw/'
-        dateFrom, dateTo = hp.defaultTimeRange(1)
-        INDICES = ['ps_packetloss', 'ps_owd', 'ps_throughput']
-        measures = pd.DataFrame()
-        for idx in INDICES:
-            df = pd.DataFrame(self.queryData(idx, dateFrom, dateTo))
-            # pq.writeToFile(df, f'{location}{idx}.parquet')
-            df.loc[:, 'src'] = df['src'].str.upper()
-            df.loc[:, 'dest'] = df['dest'].str.upper()
-            df.loc[:, 'src_site'] = df['src_site'].str.upper()
-            df.loc[:, 'dest_site'] = df['dest_site'].str.upper()
-            df['idx'] = idx
-            measures = pd.concat([measures, df])
-        self.pq.writeToFile(measures, f'{location}measures.parquet')
+        location = 'raw/measures/'
+
+        with ThreadPoolExecutor(max_workers=len(MEASURES)) as pool:
+            results = list(pool.map(lambda idx: self.updateMeasures(idx, location), MEASURES))
+
+        with self.pq.publish() as snap:
+            for partitions, expired in results:
+                for filename, df in partitions.items():
+                    snap.writeToFile(df, filename)
+                for filename in expired:
+                    snap.removeFile(filename)
+
+            files = snap.glob(f'{location}idx=*/window=*.parquet')
+            windows = [int(os.path.basename(f)[len('window='):-len('.parquet')]) for f in files]
+            snap.record('measures', snap.countRows(files),
+                        min(windows, default=None), max(windows, default=None))
 
 
     # @timer  
@@ -162,76 +225,236 @@ class ParquetUpdater(object):
     @timer
     def storeMetaData(self):
         metaDf = qrs.getMetaData()
-        self.pq.writeToFile(metaDf, f"{self.location}raw/metaDf.parquet")
+        with self.pq.publish() as snap:
+            snap.writeToFile(metaDf, "raw/metaDf.parquet")
+            snap.record('metaDf', len(metaDf))
+
+
+    @staticmethod
+    def alarmsWatermark(event, df):
+        # 'path changed between sites' comes from ps_traces_changes and it is synced on to_date,
+        # the rest of the events come from aaas_alarms and they are synced on created_at
+        field = 'to' if event == 'path changed between sites' else 'created_at'
+        if field in df.columns and len(df) > 0:
+            return df[field].max()
+        return None
+
+
+    def loadStoredAlarms(self, oa):
+        frames, pivotFrames = {}, {}
+        # read all files from the same snapshot
+        pq = Parquet(self.pq.root())
+        for f in pq.glob("frames/*"):
+            filename = os.path.basename(f)
+            pivotFile = f"pivot/{filename}"
+            if os.path.exists(pq.path(pivotFile)):
+                event = oa.eventUF(filename)
+                frames[event] = pq.readFile(f)
+                pivotFrames[event] = pq.readFile(pivotFile)
+        return frames, pivotFrames
+
+
+    # alarm_id identifies an alarm of aaas_alarms. The changes of ps_traces_changes
+    # (and the alarms without one) are identified by their fields holding a single value
+    @staticmethod
+    def alarmKeys(df, columns):
+        if 'alarm_id' in columns:
+            return df['alarm_id'].astype(str)
+        return df[columns].astype(str).agg('|'.join, axis=1)
+
+    @staticmethod
+    def keyColumns(fdf, stored):
+        if 'alarm_id' in fdf.columns and 'alarm_id' in stored.columns:
+            return ['alarm_id']
+        return [c for c in fdf.columns if c != 'id' and c in stored.columns
+                and not fdf[c].map(pd.api.types.is_list_like).any()]
+
+    @staticmethod
+    def mergeAlarms(frames, pivotFrames, newFrames, newPivotFrames):
+        changed = set()
+        for event, fdf in newFrames.items():
+            if event in frames and len(frames[event]) > 0 and len(fdf) > 0:
+                # the alarms since the watermark minus the lookback are queried
+                # again (see qrs.WATERMARK_LOOKBACK), the ones already stored are dropped
+                columns = ParquetUpdater.keyColumns(fdf, frames[event])
+                known = ParquetUpdater.alarmKeys(fdf, columns).isin(ParquetUpdater.alarmKeys(frames[event], columns))
+                pdf = newPivotFrames[event]
+                newPivotFrames[event] = pdf[~pdf['id'].isin(fdf['id'][known])].copy()
+                fdf = fdf[~known].copy()
+
+            if len(fdf) == 0:
+                continue
+
+            if event in frames and len(frames[event]) > 0:
+                # the ids of the new alarms continue after the stored ones
+                offset = frames[event]['id'].max() + 1
+                fdf.index = fdf.index + offset
+                fdf['id'] = fdf['id'] + offset
+                pdf = newPivotFrames[event]
+                pdf.index = pdf.index + offset
+                pdf['id'] = pdf['id'] + offset
+
+                frames[event] = pd.concat([frames[event], fdf])
+                pivotFrames[event] = pd.concat([pivotFrames[event], pdf])
+            else:
+                frames[event] = fdf
+                pivotFrames[event] = newPivotFrames[event]
+            changed.add(event)
+
+        return changed
+
+
+    @staticmethod
+    def expireAlarms(frames, pivotFrames, dateFrom):
+        changed = set()
+        createdFrom = hp.GetTimeRanges(dateFrom, dateFrom)[0]
+        for event, fdf in frames.items():
+            if event == 'path changed between sites':
+                expired = fdf['to'] < dateFrom
+            else:
+                expired = fdf['created_at'] < createdFrom
+
+            if expired.any():
+                pdf = pivotFrames[event]
+                frames[event] = fdf[~expired]
+                pivotFrames[event] = pdf[~pdf['id'].isin(fdf[expired]['id'])]
+                changed.add(event)
+
+        return changed
+
+
+    # The alarms are stored with the types of Alarms.schema. A field which does not
+    # fit them (e.g. after a change on the ES side) is stored with the inferred type instead,
+    # the mismatch is reported once per file so that it is not lost in the logs of every run
+    schemaMismatches = set()
+
+    @staticmethod
+    def writeAlarms(snap, event, df, filename, pivot=False):
+        try:
+            snap.writeToFile(df, filename, Alarms.schema(event, df, pivot))
+        except pa.ArrowException:
+            if filename not in ParquetUpdater.schemaMismatches:
+                ParquetUpdater.schemaMismatches.add(filename)
+                print(f'{filename} does not fit the schema of {event}, it is stored with the inferred types')
+                print(traceback.format_exc())
+            snap.writeToFile(df, filename)
 
 
     @timer
     def storeAlarms(self):
         dateFrom, dateTo = hp.defaultTimeRange(60)
-        print("Update data. Get all alarms for the past 60 days...", dateFrom, dateTo)
         oa = Alarms()
-        frames, pivotFrames = oa.getAllAlarms(dateFrom, dateTo)
-        self.groupAlarms(pivotFrames)
+        frames, pivotFrames = self.loadStoredAlarms(oa)
+        watermarks = {event: self.alarmsWatermark(event, df) for event, df in frames.items()}
+
+        # Frames stored without a watermark (e.g. before the incremental sync was introduced)
+        # cannot be merged safely, so all alarms for the past 60 days are reloaded
+        if not frames or None in watermarks.values():
+            print("Update data. Get all alarms for the past 60 days...", dateFrom, dateTo)
+            frames, pivotFrames = oa.getAllAlarms(dateFrom, dateTo)
+            changed = set(frames.keys())
+        else:
+            print("Update data. Get the alarms newer than the stored ones...", watermarks)
+            newFrames, newPivotFrames = oa.getAllAlarms(dateFrom, dateTo, watermarks)
+            changed = self.mergeAlarms(frames, pivotFrames, newFrames, newPivotFrames)
+
+        changed |= self.expireAlarms(frames, pivotFrames, dateFrom)
+
+        # the frames, the pivot frames and the grouped alarms are published together
+        with self.pq.publish() as snap:
+            self.groupAlarms(pivotFrames, snap)
+
+            for event in changed:
+                filename = oa.eventCF(event)
+                fdf = frames[event]
+                if len(fdf)>0:
+                    self.writeAlarms(snap, event, pivotFrames[event], f"pivot/{filename}", pivot=True)
+                    self.writeAlarms(snap, event, fdf, f"frames/{filename}")
+                else:
+                    snap.removeFile(f"frames/{filename}")
+                    snap.removeFile(f"pivot/{filename}")
 
-        for event,df in pivotFrames.items():
-            filename = oa.eventCF(event)
-            fdf = frames[event]
-            if len(fdf)>0:
-                self.pq.writeToFile(df, f"parquet/pivot/{filename}")
-                self.pq.writeToFile(fdf, f"parquet/frames/{filename}")
+            snap.record('alarms', sum(len(fdf) for fdf in frames.values()), dateFrom, dateTo)
 
 
+    # Describes how the path of each pair changed: at which position every ASN from "diff"
+    # appeared and which ASNs it replaced there ("jumpedFrom"). All pairs are processed
+    # together with merges, owners is the result of a single ASN lookup for all of them
     @staticmethod
-    def descChange(chdf, posDf):
-        owners = qrs.getASNInfo(posDf['asn'].values.tolist())
-        owners['-1'] = 'OFF/Unavailable'
-        howPathChanged = []
-        for diff in chdf['diff'].values.tolist()[0]:
-
-            for pos, P in posDf[(posDf['asn'] == diff)][['pos', 'P']].values:
-                atPos = list(set(posDf[(posDf['pos'] == pos)]['asn'].values.tolist()))
-
-                if len(atPos) > 0:
-                    atPos.remove(diff)
-                    for newASN in atPos:
-                        if newASN not in [0, -1]:
-                            if P < 1:
-                                if str(newASN) in owners.keys():
-                                    owner = owners[str(newASN)]
-                                howPathChanged.append({'diff': diff,
-                                            'diffOwner': owners[str(diff)], 'atPos': pos,
-                                            'jumpedFrom': newASN, 'jumpedFromOwner': owner})
-                # the following check is covering the cases when the change happened at the very end of the path
-                # i.e. the only ASN that appears at that position is the diff detected
-                if len(atPos) == 0:
-                    howPathChanged.append({'diff': diff,
-                                        'diffOwner': owners[str(diff)], 'atPos': pos,
-                                        'jumpedFrom': 0, 'jumpedFromOwner': ''})
-
-        if len(howPathChanged) > 0:
-            return pd.DataFrame(howPathChanged).sort_values('atPos')
-
-        return pd.DataFrame()
+    def descChange(chdf, posDf, baseline, owners):
+        pairOrder = pd.Series(range(posDf['pair'].nunique()), index=posDf['pair'].unique())
+
+        # only the diff of the first change found for the pair is described
+        diffs = chdf.drop_duplicates('pair')[['pair', 'diff']].explode('diff').dropna()
+        diffs['diff'] = diffs['diff'].astype(posDf['asn'].dtype)
+        diffs['diffOrder'] = range(len(diffs))
+
+        positions = posDf[['pair', 'asn', 'pos', 'P']].copy()
+        positions['rowOrder'] = range(len(positions))
+
+        # all positions where the diff was seen and the number of ASNs seen at each of them
+        atPos = posDf[['pair', 'pos', 'asn']].drop_duplicates()
+        seen = diffs.merge(positions, left_on=['pair', 'diff'], right_on=['pair', 'asn']).drop(columns='asn')
+        seen = seen.merge(atPos.groupby(['pair', 'pos']).size().rename('nAtPos').reset_index(), on=['pair', 'pos'])
+
+        jumps = seen[seen['P'] < 1].merge(atPos.rename(columns={'asn': 'jumpedFrom'}), on=['pair', 'pos'])
+        jumps = jumps[(jumps['jumpedFrom'] != jumps['diff']) & ~jumps['jumpedFrom'].isin([0, -1])]
+        jumps['jumpedFromOwner'] = jumps['jumpedFrom'].astype(str).map(owners).fillna('')
+
+        # the following check is covering the cases when the change happened at the very end of the path
+        # i.e. the only ASN that appears at that position is the diff detected
+        ends = seen[seen['nAtPos'] == 1].assign(jumpedFrom=0, jumpedFromOwner='')
+
+        df = pd.concat([jumps, ends])
+        if len(df) == 0:
+            return pd.DataFrame()
+
+        df['diffOwner'] = df['diff'].astype(str).map(owners).fillna('')
+        df['pairOrder'] = df['pair'].map(pairOrder)
+        # the rows of a pair are numbered in the order they were found, then ordered by position
+        df = df.sort_values(['pairOrder', 'diffOrder', 'rowOrder', 'jumpedFrom'])
+        df.index = df.groupby('pair').cumcount().values
+        df = df.sort_values(['pairOrder', 'pos'], kind='stable')
+        # pos comes together with P from the positions, so it is a float
+        df['atPos'] = df['pos'].astype(float)
+
+        sites = baseline.drop_duplicates('pair').set_index('pair')
+        df['src_site'] = df['pair'].map(sites['src_site'])
+        df['dest_site'] = df['pair'].map(sites['dest_site'])
+        df['count'] = df['pair'].map(chdf['pair'].value_counts())
+
+        return df[['diff', 'diffOwner', 'atPos', 'jumpedFrom', 'jumpedFromOwner', 'src_site', 'dest_site', 'count']]
 
 
     @timer
     def storePathChangeDescDf(self):
         dateFrom, dateTo = hp.defaultTimeRange(days=2)
-        chdf, posDf, baseline = qrs.queryTraceChanges(dateFrom, dateTo)[:3]
+        chdf, posDf, baseline = qrs.queryTraceChanges(dateFrom, dateTo, details=('positions', 'baseline'), cache=False)[:3]
 
         df = pd.DataFrame()
         if len(chdf) > 0:
-            for p in posDf['pair'].unique():
-                # print(p)
-                temp = self.descChange(chdf[chdf['pair'] == p], posDf[posDf['pair'] == p])
-                temp['src_site'] = baseline[baseline['pair'] == p]['src_site'].values[0]
-                temp['dest_site'] = baseline[baseline['pair'] == p]['dest_site'].values[0]
-                temp['count'] = len(chdf[chdf['pair'] == p])
-                df = pd.concat([df, temp])
+            # a single lookup for the owners of all ASNs
+            owners = asnOwners.get(posDf['asn'].unique().tolist(), wait=True, cache=False)
+            owners['-1'] = 'OFF/Unavailable'
+            df = self.descChange(chdf, posDf, baseline, owners)
 
+        if len(df) > 0:
             df['jumpedFrom'] = df['jumpedFrom'].astype(int)
             df['diff'] = df['diff'].astype(int)
-            self.pq.writeToFile(df, f"parquet/frames/prev_next_asn")
+
+        with self.pq.publish() as snap:
+            if len(df) > 0:
+                snap.writeToFile(df, "frames/prev_next_asn")
+            snap.record('prev_next_asn', len(df), dateFrom, dateTo)
+            # keep the owners found in ES for the other processes
+            asnOwners.flush(snap)
+
+
+    @timer
+    def storeASNOwners(self):
+        with self.pq.publish() as snap:
+            rows = asnOwners.store(snap)
+            snap.record('asnOwners', rows)
 
 
     @staticmethod
@@ -251,17 +474,21 @@ class ParquetUpdater(object):
 
         rawDf = createThrptDataset(start_date, end_date)
 
-        self.pq.writeToFile(rawDf, f'{self.location}ml-datasets/throughput_Df.parquet')
+        # the dataset is staged until the model is ready, so that both are published together
+        self.staging.writeToFile(rawDf, 'throughput_Df.parquet')
 
         # train the ML model on the loaded dataset
         rawDf_onehot, model = trainMLmodel(rawDf)
         del rawDf
 
-        self.pq.writeToFile(rawDf_onehot, f'{self.location}ml-datasets/throughput_onehot_Df.parquet')
-        # save the classification model as a pickle file
-        model_pkl_file = f'{self.location}ml-datasets/XGB_Classifier_model_throughput.pkl'
-        with open(model_pkl_file, 'wb') as file:
-            pickle.dump(model, file)
+        with self.pq.publish() as snap:
+            snap.importFile(self.staging.path('throughput_Df.parquet'), 'ml-datasets/throughput_Df.parquet')
+            snap.writeToFile(rawDf_onehot, 'ml-datasets/throughput_onehot_Df.parquet')
+            # save the classification model as a pickle file
+            model_pkl_file = snap.newFile('ml-datasets/XGB_Classifier_model_throughput.pkl')
+            with open(model_pkl_file, 'wb') as file:
+                pickle.dump(model, file)
+            snap.record('throughput_model', len(rawDf_onehot), start_date, end_date)
 
 
     @timer
@@ -272,47 +499,138 @@ class ParquetUpdater(object):
         start_date, end_date = [f'{start_date}T00:01:00.000Z', f'{end_date}T23:59:59.000Z']
 
         plsDf = createPcktDataset(start_date, end_date)
-        self.pq.writeToFile(plsDf, f'{self.location}ml-datasets/packet_loss_Df.parquet')
+        # the datasets are staged until the model is ready, so that all are published together
+        self.staging.writeToFile(plsDf, 'packet_loss_Df.parquet')
 
         # onehot encode the whole dataset and leave only one month for further ML training
         plsDf_onehot_month, plsDf_onehot = one_month_data(plsDf)
-        self.pq.writeToFile(plsDf_onehot, f'{self.location}ml-datasets/packet_loss_onehot_Df.parquet')
+        self.staging.writeToFile(plsDf_onehot, 'packet_loss_onehot_Df.parquet')
         del plsDf_onehot
 
         # train the model on one month data
         model = packet_loss_train_model(plsDf_onehot_month)
         del plsDf_onehot_month
 
-        # save the classification model as a pickle file
-        model_pkl_file = f'{self.location}ml-datasets/XGB_Classifier_model_packet_loss.pkl'
-        with open(model_pkl_file, 'wb') as file:
-            pickle.dump(model, file)
+        with self.pq.publish() as snap:
+            snap.importFile(self.staging.path('packet_loss_Df.parquet'), 'ml-datasets/packet_loss_Df.parquet')
+            snap.importFile(self.staging.path('packet_loss_onehot_Df.parquet'), 'ml-datasets/packet_loss_onehot_Df.parquet')
+            # save the classification model as a pickle file
+            model_pkl_file = snap.newFile('ml-datasets/XGB_Classifier_model_packet_loss.pkl')
+            with open(model_pkl_file, 'wb') as file:
+                pickle.dump(model, file)
+            snap.record('packet_loss_model', snap.countRows(['ml-datasets/packet_loss_onehot_Df.parquet']),
+                        start_date, end_date)
 
 
 
 class Scheduler(object):
-    def __init__(self, interval, function, *args, **kwargs):
-        self._timer = None
+    # Runs a function periodically in a dedicated thread. The next run is planned
+    # only after the current one has finished, so a job never overlaps with itself.
+    # After a failure the job is retried with an exponential backoff (capped at the interval)
+    jobs = {}
+
+    def __init__(self, interval, function, *args, name=None, jitter=0.1, retryAfter=60, **kwargs):
         self.interval = interval
         self.function = function
         self.args = args
         self.kwargs = kwargs
-        self.is_running = False
-        self.next_call = time.time()
+        self.name = name if name else function.__name__
+        self.jitter = jitter
+        self.retryAfter = retryAfter
+
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.statsLock = threading.Lock()
+        self._stats = {
+            'interval': interval,
+            'running': False,
+            'lastStart': None,
+            'lastDuration': None,
+            'lastSuccess': None,
+            'lastFailure': None,
+            'failures': 0,
+            'consecutiveFailures': 0,
+            'nextRun': None,
+        }
+
+        Scheduler.jobs[self.name] = self
         self.start()
 
-    def _run(self):
-        self.is_running = False
-        self.start()
-        self.function(*self.args, **self.kwargs)
+    @classmethod
+    def stats(cls):
+        return {name: job.getStats() for name, job in cls.jobs.items()}
+
+    def getStats(self):
+        with self.statsLock:
+            return dict(self._stats)
+
+    def _update(self, **values):
+        with self.statsLock:
+            self._stats.update(values)
+
+    def delay(self):
+        failures = self._stats['consecutiveFailures']
+        delay = self.interval
+        if failures > 0:
+            delay = min(self.interval, self.retryAfter * 2**(failures-1))
+        # spread the jobs, so that they don't hit ES at the same moment
+        return delay + random.uniform(0, self.jitter * delay)
+
+    def run(self):
+        # guarantees at most one run of the job at a time
+        if not self._lock.acquire(blocking=False):
+            print(f"{self.name!r} is still running. Skipping...")
+            return False
+
+        start = time.time()
+        self._update(running=True, lastStart=datetime.fromtimestamp(start))
+        try:
+            self.function(*self.args, **self.kwargs)
+            self._update(lastSuccess=datetime.now(), consecutiveFailures=0)
+            return True
+        except Exception as e:
+            print(f"{self.name!r} failed:", e)
+            print(traceback.format_exc())
+            with self.statsLock:
+                self._stats['failures'] += 1
+                self._stats['consecutiveFailures'] += 1
+                self._stats['lastFailure'] = datetime.now()
+            return False
+        finally:
+            self._update(running=False, lastDuration=round(time.time() - start, 2))
+            self._lock.release()
+
+    def _loop(self):
+        while not self._stopped.wait(max(0, self.next_call - time.time())):
+            self.run()
+            self.next_call = time.time() + self.delay()
+            self._update(nextRun=datetime.fromtimestamp(self.next_call))
 
     def start(self):
-        if not self.is_running:
-            self.next_call += self.interval
-            self._timer = threading.Timer(self.next_call - time.time(), self._run)
-            self._timer.start()
-            self.is_running = True
+        self._stopped.clear()
+        self.next_call = time.time() + self.delay()
+        self._update(nextRun=datetime.fromtimestamp(self.next_call))
+        self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+        self._thread.start()
 
     def stop(self):
-        self._timer.cancel()
-        self.is_running = False
+        self._stopped.set()
+        self._update(nextRun=None)
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Updates the data cached in parquet/')
+    parser.add_argument('--worker', action='store_true',
+                        help='keep running and own all scheduled refresh jobs (use with PS_DASH_MODE=web for the app)')
+    args = parser.parse_args()
+
+    # refreshes the stale data and schedules the jobs
+    ParquetUpdater()
+
+    if args.worker:
+        # the jobs run in daemon threads, so the main thread keeps the process alive
+        while True:
+            time.sleep(60*60)
+            for name, stats in Scheduler.stats().items():
+                print(name, stats)
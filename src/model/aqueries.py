@@ -0,0 +1,148 @@
+import os
+import copy
+import asyncio
+import functools
+import contextvars
+import threading
+
+from elasticsearch.helpers import async_scan
+
+import utils.helpers as hp
+import model.queries as qrs
+
+
+# Async variants of the queries in model.queries, built on the async ES client.
+# The coroutines run on a single event loop in a background thread, so that the
+# (synchronous) page callbacks can send several queries at once and wait for all of them:
+#
+#   alarm, (chdf, posDf, baseline, altPaths) = aqrs.gather(aqrs.getAlarm(q), aqrs.queryTraceChanges(dateFrom, dateTo))
+#
+_loop = None
+_es = None
+_lock = threading.Lock()
+# the requests in flight on the loop, see qrs.SingleFlight
+_inFlight = {}
+
+
+# the loop thread does not exist in a forked process, a new one is started there
+def _reset():
+  global _loop, _es, _lock, _inFlight
+  _loop, _es, _lock, _inFlight = None, None, threading.Lock(), {}
+
+os.register_at_fork(after_in_child=_reset)
+
+
+def loop():
+  global _loop
+  with _lock:
+    if _loop is None:
+      _loop = asyncio.new_event_loop()
+      threading.Thread(target=_loop.run_forever, name='aqueries', daemon=True).start()
+  return _loop
+
+
+# the client is bound to the loop, so it is created from a coroutine running on it
+def es():
+  global _es
+  if _es is None:
+    _es = hp.ConnectAsyncES()
+  return _es
+
+
+# Runs the coroutines concurrently and returns their results in the same order.
+# The waiting time is the one of the slowest query instead of the sum of all.
+# The coroutines (and inThread) run in a copy of the caller's context,
+# so the flask request context and its pinned snapshot are kept
+async def _gather(*aws):
+  return await asyncio.gather(*aws)
+
+
+def gather(*aws):
+  return asyncio.run_coroutine_threadsafe(_gather(*aws), loop()).result()
+
+
+def run(aw):
+  return gather(aw)[0]
+
+
+# local work (e.g. reading the parquet files) done alongside the queries
+async def inThread(func, *args, **kwargs):
+  call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+  return await asyncio.get_running_loop().run_in_executor(None, call)
+
+
+# see qrs.cachedCall
+def cached(key, factory, ttl):
+  async def call():
+    response = await factory()
+    qrs.results.put(key, copy.deepcopy(response), ttl)
+    return response
+
+  return call
+
+
+# Identical requests in flight share one ES call, like qrs.SingleFlight does for the
+# threads. Everything runs on the loop, so no lock is needed. The call is removed
+# from _inFlight before the callers are resumed, hence no one joins a finished call
+async def shared(key, factory, ttl=None):
+  if ttl:
+    hit = qrs.results.get(key)
+    if hit is not None:
+      return copy.deepcopy(hit)
+
+    # the cache is shared with model.queries, it is filled once by the leader
+    factory = cached(key, factory, ttl)
+
+  call = _inFlight.get(key)
+  if call is None:
+    call = _inFlight[key] = {'task': asyncio.ensure_future(factory()), 'callers': 0}
+    call['task'].add_done_callback(lambda t: _inFlight.pop(key, None))
+  call['callers'] += 1
+
+  result = await asyncio.shield(call['task'])
+  return copy.deepcopy(result) if call['callers'] > 1 else result
+
+
+async def search(index, ttl=None, **params):
+  async def send():
+    response = await es().search(index=index, **params)
+    return getattr(response, 'body', response)
+
+  return await shared(qrs.requestKey('search', index, params), send, ttl)
+
+
+# the async counterpart of qrs.slicedScan, the slices are read concurrently on the loop
+async def slicedScan(index, query, slices=1, ttl=None):
+  async def scanSlice(q):
+    return [item async for item in async_scan(es(), index=index, query=q)]
+
+  async def scanAll():
+    if slices <= 1:
+      return await scanSlice(query)
+    hits = await asyncio.gather(*(scanSlice({**query, "slice": {"id": i, "max": slices}}) for i in range(slices)))
+    return [item for sliceHits in hits for item in sliceHits]
+
+  return await shared(qrs.requestKey('scan', index, {'query': query, 'slices': slices}), scanAll, ttl)
+
+
+async def getAlarm(id, cache=True):
+  response = await search('aaas_alarms', qrs.cacheTTL('getAlarm', cache), size=100, query=qrs.alarmQuery(id), _source=qrs.ALARM_FIELDS)
+  return qrs.decodeAlarm(response)
+
+
+async def getCategory(event, cache=True):
+  response = await search('aaas_categories', qrs.cacheTTL('getCategory', cache), query=qrs.categoryQuery(event))
+  return qrs.decodeCategory(response)
+
+
+# the category is needed to describe the alarm, so it is queried right after it
+async def getAlarmAndCategory(id):
+  alarm = await getAlarm(id)
+  return alarm, await getCategory(alarm['event'])
+
+
+async def queryTraceChanges(dateFrom, dateTo, slices=2, details=qrs.TRACE_DETAILS, cache=True):
+  q = qrs.traceChangesQuery(dateFrom, dateTo, details)
+  hits = await slicedScan('ps_traces_changes', q, slices, qrs.cacheTTL('queryTraceChanges', cache))
+  # the decoding does not wait on ES, it runs outside the loop
+  return await inThread(qrs.decodeTraceChanges, hits)
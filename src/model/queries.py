@@ -1,4 +1,11 @@
+import copy
+import json
+import time
+import threading
 import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from itertools import chain
 from elasticsearch.helpers import scan
 from datetime import datetime
 import pandas as pd
@@ -25,7 +32,224 @@ def obtainFieldNames(dateFrom):
     return 'src_site', 'dest_site'
 
 
-def queryThroughputIdx(dateFrom, dateTo):
+# Identical requests sent at the same time, e.g. by the many people opening the same alarm
+# from a notification, share a single ES call and its response.
+# The callers modify the documents they decode, so when the response was shared
+# each of them gets its own copy and the original is left untouched
+class SingleFlight(object):
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.calls = {}
+
+  def do(self, key, fn):
+    with self.lock:
+      call = self.calls.get(key)
+      leader = call is None
+      if leader:
+        call = self.calls[key] = {'result': Future(), 'callers': 1}
+      else:
+        call['callers'] += 1
+
+    if not leader:
+      return copy.deepcopy(call['result'].result())
+
+    try:
+      call['result'].set_result(fn())
+    except Exception as e:
+      call['result'].set_exception(e)
+    finally:
+      # no one can join once the call is removed
+      with self.lock:
+        del self.calls[key]
+
+    result = call['result'].result()
+    return copy.deepcopy(result) if call['callers'] > 1 else result
+
+
+inFlight = SingleFlight()
+
+
+# How long (in seconds) the results of the following queries are reused.
+# The callers which need fresh data (e.g. the updater) pass cache=False
+CACHE_TTL = {
+  'getAlarm': 60*60,
+  'getCategory': 60*60,
+  'getASNInfo': 60*60,
+  'queryTraceChanges': 60*5,
+}
+# max number of responses kept, the least recently used ones are evicted
+CACHE_ENTRIES = 256
+
+
+class ResultCache(object):
+
+  def __init__(self, maxEntries=CACHE_ENTRIES):
+    self.maxEntries = maxEntries
+    # key -> (expiration time, response)
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None and entry[0] < time.time():
+        del self.entries[key]
+        self.counters['expirations'] += 1
+        entry = None
+
+      if entry is None:
+        self.counters['misses'] += 1
+        return None
+
+      self.entries.move_to_end(key)
+      self.counters['hits'] += 1
+      return entry[1]
+
+  def put(self, key, value, ttl):
+    with self.lock:
+      self.entries[key] = (time.time() + ttl, value)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.maxEntries:
+        self.entries.popitem(last=False)
+        self.counters['evictions'] += 1
+
+  def stats(self):
+    with self.lock:
+      return {**self.counters, 'entries': len(self.entries)}
+
+
+results = ResultCache()
+
+
+def cacheTTL(function, cache):
+  return CACHE_TTL[function] if cache else None
+
+
+# a request is identified by its type, index and the canonical JSON of its parameters
+def requestKey(kind, index, params):
+  return (kind, index, json.dumps(params, sort_keys=True, default=str))
+
+
+# Wraps the call so that its response is kept in the cache for ttl seconds.
+# The cache holds an untouched copy, since the callers modify theirs
+def cachedCall(key, fn, ttl):
+  def call():
+    response = fn()
+    results.put(key, copy.deepcopy(response), ttl)
+    return response
+
+  return call
+
+
+# Sends the request, or shares the one in flight. With a ttl a cached response is reused
+def sharedCall(key, fn, ttl=None):
+  if ttl:
+    cached = results.get(key)
+    if cached is not None:
+      return copy.deepcopy(cached)
+    fn = cachedCall(key, fn, ttl)
+
+  return inFlight.do(key, fn)
+
+
+def search(index, ttl=None, **params):
+  def send():
+    response = hp.es.search(index=index, **params)
+    # the response of the 8.x client wraps the body
+    return getattr(response, 'body', response)
+
+  return sharedCall(requestKey('search', index, params), send, ttl)
+
+
+# Scans the index with "slices" scroll cursors read in parallel (sliced scroll),
+# so that the large scans use several shards of the cluster at a time.
+# The documents of all slices are returned together, in no particular order
+def slicedScan(index, query, slices=1, ttl=None, **kwargs):
+  def scanAll():
+    if slices <= 1:
+      return list(scan(client=hp.es, index=index, query=query, **kwargs))
+
+    def scanSlice(i):
+      return list(scan(client=hp.es, index=index, query={**query, "slice": {"id": i, "max": slices}}, **kwargs))
+
+    with ThreadPoolExecutor(max_workers=slices) as pool:
+      return list(chain.from_iterable(pool.map(scanSlice, range(slices))))
+
+  return sharedCall(requestKey('scan', index, {'query': query, 'slices': slices, **kwargs}), scanAll, ttl)
+
+
+# A composite aggregation returns at most "size" buckets per response.
+# The following pages are requested with the after_key of the previous one
+# until all the buckets are collected
+def compositePages(idx, body, name='groupby'):
+  composite = body['aggregations'][name]['composite']
+  while True:
+    aggdata = search(idx, body=body, _source=False)
+    agg = aggdata['aggregations'][name]
+    yield agg['buckets']
+
+    if 'after_key' not in agg or len(agg['buckets']) < composite['size']:
+      break
+    composite['after'] = agg['after_key']
+
+
+# Decodes the buckets of the averages queries into columns, page by page, so that
+# only one page of bucket dicts is held at a time and no dict is built per row.
+# The time bounds come from the "bin" key for time-binned queries
+def decodeAvgBuckets(pages, keys, metric, dateFrom, dateTo, binSize=None):
+  keys = keys + ['bin'] if binSize else keys
+  frames = []
+  for buckets in pages:
+    if not buckets:
+      continue
+    columns = {k: [b['key'][k] for b in buckets] for k in keys}
+    columns['value'] = [b[metric]['value'] for b in buckets]
+    columns['doc_count'] = [b['doc_count'] for b in buckets]
+    frames.append(pd.DataFrame(columns))
+
+  df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=keys+['value', 'doc_count'])
+  df['value'] = df['value'].astype(float)
+
+  if binSize:
+    df['from'] = df.pop('bin').astype('int64')
+    df['to'] = df['from'] + binSize
+  else:
+    df['from'] = dateFrom
+    df['to'] = dateTo
+  return df
+
+
+# the names of the hosts and sites are stored in upper case
+def upperCase(df, columns=['src', 'dest', 'src_site', 'dest_site']):
+  for col in columns:
+    df[col] = df[col].str.upper()
+  return df
+
+
+# Turns a query over the whole period into a time-binned one: a date_histogram source
+# is put first in the composite aggregation, so that a single paginated query returns
+# the buckets of every pair in every bin (in time order). The bins start at dateFrom,
+# are binSize ms long and include their start, hence the range includes it too
+def addTimeBins(body, dateFrom, dateTo, binSize, name='groupby'):
+  for condition in body['query']['bool']['must']:
+    if 'range' in condition and 'timestamp' in condition['range']:
+      condition['range']['timestamp'] = {"gte": dateFrom, "lt": dateTo, "format": "epoch_millis"}
+
+  body['aggregations'][name]['composite']['sources'].insert(0, {
+    "bin": {
+      "date_histogram": {
+        "field": "timestamp",
+        "fixed_interval": f"{binSize}ms",
+        "offset": f"+{dateFrom % binSize}ms"
+      }
+    }
+  })
+
+
+# binSize (ms) returns the averages per time bin instead of over the whole period
+def queryThroughputIdx(dateFrom, dateTo, binSize=None):
   # dateFrom = datetime.fromisoformat(dateFrom)
   # dateTo = datetime.fromisoformat(dateTo)
   query = {
@@ -124,23 +348,23 @@ def queryThroughputIdx(dateFrom, dateTo):
     }
 
     #     print(idx, str(query).replace("\'", "\""))
-  aggrs = []
-
-  aggdata = hp.es.search(index='ps_throughput', query=query, aggregations=aggregations, _source=False)
-  for item in aggdata['aggregations']['groupby']['buckets']:
-      aggrs.append({'hash': str(item['key']['src'] + '-' + item['key']['dest']),
-                    'from': dateFrom, 'to': dateTo,
-                    'ipv6': item['key']['ipv6'],
-                    'src': item['key']['src'].upper(), 'dest': item['key']['dest'].upper(),
-                    'src_host': item['key']['src_host'], 'dest_host': item['key']['dest_host'],
-                    'src_site': item['key']['src_site'].upper(), 'dest_site': item['key']['dest_site'].upper(),
-                    'value': item['throughput']['value'],
-                    'doc_count': item['doc_count']
-                    })
-
-  return aggrs
-
-def queryPathChanged(dateFrom, dateTo):
+  body = {"size": 0, "query": query, "aggregations": aggregations}
+  if binSize:
+    addTimeBins(body, dateFrom, dateTo, binSize)
+
+  keys = ['ipv6', 'src', 'dest', 'src_host', 'dest_host', 'src_site', 'dest_site']
+  df = decodeAvgBuckets(compositePages('ps_throughput', body), keys, 'throughput', dateFrom, dateTo, binSize)
+  df['hash'] = df['src'] + '-' + df['dest']
+
+  return upperCase(df)[['hash', 'from', 'to'] + keys + ['value', 'doc_count']]
+
+# The alarms are synced from a watermark (see queryAlarms) minus this lookback in ms, so that
+# the ones indexed late or sharing the time of the watermark are not missed. The updater drops
+# the alarms it already stored
+WATERMARK_LOOKBACK = 60*60*1000
+
+
+def queryPathChanged(dateFrom, dateTo, watermark=None):
     # start = datetime.strptime(dateFrom, '%Y-%m-%dT%H:%M:%S.000Z')
     # end = datetime.strptime(dateTo, '%Y-%m-%dT%H:%M:%S.000Z')
     # if (end - start).days < 2:
@@ -170,8 +394,18 @@ def queryPathChanged(dateFrom, dateTo):
           }
         }
     }
+    # only the changes since the ones already stored
+    if watermark is not None:
+      q['query']['bool']['must'].append({
+        "range": {
+          "to_date": {
+            "gte": f"{watermark}||-{WATERMARK_LOOKBACK // 1000}s",
+            "format": "strict_date_optional_time"
+          }
+        }
+      })
     # print(str(q).replace("\'", "\""))
-    result = scan(client=hp.es, index='ps_traces_changes', query=q)
+    result = slicedScan('ps_traces_changes', q)
     data = []
 
     for item in result:
@@ -187,9 +421,14 @@ def queryPathChanged(dateFrom, dateTo):
 
 
 
-def queryAlarms(dateFrom, dateTo):
+# watermarks maps an event to the most recent created_at (to_date for 'path changed between sites')
+# already stored. When given, only the alarms since the watermarks minus WATERMARK_LOOKBACK are returned
+def queryAlarms(dateFrom, dateTo, watermarks=None, slices=4):
   period = hp.GetTimeRanges(dateFrom, dateTo)
+  watermarks = watermarks or {}
+  createdWatermarks = [v for e, v in watermarks.items() if e != 'path changed between sites']
   q = {
+        "_source": ["event", "created_at", "source", "tags"],
         "query": {
             "bool": {
                 "must": [
@@ -214,13 +453,24 @@ def queryAlarms(dateFrom, dateTo):
             }
         }
         }
+  if createdWatermarks:
+    q['query']['bool']['must'].append({
+        "range": {
+            "created_at": {
+                "gte": int(min(createdWatermarks)) - WATERMARK_LOOKBACK,
+                "format": "epoch_millis"
+            }
+        }
+    })
   # print(str(q).replace("\'", "\""))
   try:
-    result = scan(client=hp.es, index='aaas_alarms', query=q)
+    result = slicedScan('aaas_alarms', q, slices)
     data = {}
 
     for item in result:
         event = item['_source']['event']
+        if event in watermarks and item['_source']['created_at'] < watermarks[event] - WATERMARK_LOOKBACK:
+          continue
         # if event != 'path changed':
         temp = []
         if event in data.keys():
@@ -242,13 +492,16 @@ def queryAlarms(dateFrom, dateTo):
           if 'avg_value%' in desc.keys():
               desc['avg_value'] = desc['avg_value%']
               desc.pop('avg_value%')
+
+          # used for syncing the stored alarms incrementally
+          desc['created_at'] = item['_source']['created_at']
           
           temp.append(desc)
 
           data[event] = temp
 
     # path changed details resides in a separate index
-    pathdf = queryPathChanged(dateFrom, dateTo)
+    pathdf = queryPathChanged(dateFrom, dateTo, watermarks.get('path changed between sites'))
     data['path changed between sites'] = pathdf
     return data
   except Exception as e:
@@ -257,7 +510,8 @@ def queryAlarms(dateFrom, dateTo):
 
 
 
-def getASNInfo(ids):
+# returns the owners of the ASNs in ids, or of all ASNs when ids is None
+def getASNInfo(ids=None, cache=True):
     query = {
         "query": {
             "terms": {
@@ -265,10 +519,12 @@ def getASNInfo(ids):
             }
         }
     }
+    if ids is None:
+        query = {"query": {"match_all": {}}}
 
     # print(str(query).replace("\'", "\""))
     asnDict = {}
-    data = scan(hp.es, index='ps_asns', query=query)
+    data = slicedScan('ps_asns', query, ttl=cacheTTL('getASNInfo', cache))
     if data:
       for item in data:
           asnDict[str(item['_id'])] = item['_source']['owner']
@@ -279,9 +535,13 @@ def getASNInfo(ids):
 
 
 # TODO: start querying form ps_meta
+# the fields of ps_alarms_meta used by the pages
+META_FIELDS = ['ip', 'ipv6', 'host', 'site', 'netsite', 'netsite_original', 'lat', 'lon', 'country']
+
+
 def getMetaData():
     meta = []
-    data = scan(hp.es, index='ps_alarms_meta')
+    data = slicedScan('ps_alarms_meta', {"_source": META_FIELDS})
     for item in data:
         meta.append(item['_source'])
 
@@ -291,14 +551,22 @@ def getMetaData():
         print('No metadata!')
 
 
-def getAlarm(id):
-  q = {
+# The queries below are split in building the request and decoding the response,
+# which are shared with their async variants in model.aqueries
+# the parts of an alarm shown by the pages
+ALARM_FIELDS = ['event', 'created_at', 'source', 'tags']
+
+
+def alarmQuery(id):
+  return {
       "term": {
           "source.alarm_id": id
       }
   }
+
+
+def decodeAlarm(results):
   data = []
-  results = hp.es.search(index='aaas_alarms', size=100, query=q)
   for res in results['hits']['hits']:
     data.append(res['_source'])
 
@@ -307,19 +575,27 @@ def getAlarm(id):
     return data[0]
 
 
-def getCategory(event):
+def getAlarm(id, cache=True):
+  response = search('aaas_alarms', cacheTTL('getAlarm', cache), size=100, query=alarmQuery(id), _source=ALARM_FIELDS)
+  return decodeAlarm(response)
 
-  q = {
+
+def categoryQuery(event):
+  return {
       "term": {
           "event": event
       }
   }
 
 
-  results = hp.es.search(index='aaas_categories', query=q)
-
+def decodeCategory(results):
   for res in results['hits']['hits']:
     return res['_source']
+
+
+def getCategory(event, cache=True):
+  response = search('aaas_categories', cacheTTL('getCategory', cache), query=categoryQuery(event))
+  return decodeCategory(response)
   
 
 def getSubcategories():
@@ -363,11 +639,21 @@ def getSubcategories():
   return catdf
 
 
-def queryTraceChanges(dateFrom, dateTo):
+# The nested arrays of ps_traces_changes are the bulk of each document,
+# only the ones requested in "details" are fetched
+TRACE_DETAILS = ('positions', 'baseline', 'alt_paths')
+
+
+def traceChangesSource(details):
+  return {"excludes": ['created_at'] + [d for d in TRACE_DETAILS if d not in details]}
+
+
+def traceChangesQuery(dateFrom, dateTo, details=TRACE_DETAILS):
   # dateFrom = convertDate(dateFrom)
   # dateTo = convertDate(dateTo)
 
-  q = {
+  return {
+    "_source": traceChangesSource(details),
     "query": {
       "bool": {
         "must": [
@@ -385,16 +671,69 @@ def queryTraceChanges(dateFrom, dateTo):
     }
   }
 
+
+def queryTraceChanges(dateFrom, dateTo, slices=2, details=TRACE_DETAILS, cache=True):
+  q = traceChangesQuery(dateFrom, dateTo, details)
+  # print(str(q).replace("\'", "\""))
+  result = slicedScan('ps_traces_changes', q, slices, cacheTTL('queryTraceChanges', cache))
+  return decodeTraceChanges(result)
+
+
+# the changes where the site is either the source or the destination
+def siteTraceChangesQuery(dateFrom, dateTo, site):
+  return {
+    "_source": traceChangesSource(TRACE_DETAILS),
+    "query": {
+      "bool": {
+        "must": [
+          {
+            "range": {
+              "to_date": {
+                "gte": dateFrom,
+                "lte": dateTo,
+                "format": "strict_date_optional_time"
+              }
+            }
+          },
+          {
+            "bool": {
+              "should": [
+                {
+                  "term": {
+                    "src_site": site
+                  }
+                },
+                {
+                  "term": {
+                    "dest_site": site
+                  }
+                }
+              ]
+            }
+          }
+        ]
+      }
+    }
+  }
+
+
+def querySiteTraceChanges(dateFrom, dateTo, site, slices=2):
+  q = siteTraceChangesQuery(dateFrom, dateTo, site)
   # print(str(q).replace("\'", "\""))
-  result = scan(client=hp.es,index='ps_traces_changes',query=q)
+  result = slicedScan('ps_traces_changes', q, slices)
+  return decodeTraceChanges(result, upper=False)
+
+
+def decodeTraceChanges(result, upper=True):
   data, positions, baseline, altPaths = [],[],[],[]
   positions = []
   for item in result:
       # print(len(data))
-      item['_source']['src'] = item['_source']['src'].upper()
-      item['_source']['dest'] = item['_source']['dest'].upper()
-      item['_source']['src_site'] = item['_source']['src_site'].upper()
-      item['_source']['dest_site'] = item['_source']['dest_site'].upper()
+      if upper:
+        item['_source']['src'] = item['_source']['src'].upper()
+        item['_source']['dest'] = item['_source']['dest'].upper()
+        item['_source']['src_site'] = item['_source']['src_site'].upper()
+        item['_source']['dest_site'] = item['_source']['dest_site'].upper()
 
       tempD = {}
       for k,v in item['_source'].items():
@@ -408,7 +747,7 @@ def queryTraceChanges(dateFrom, dateTo):
       dest_site = item['_source']['dest_site']
       from_date,to_date = item['_source']['from_date'], item['_source']['to_date']
 
-      temp = item['_source']['positions']
+      temp = item['_source'].get('positions', [])
       for p in temp:
           p['src'] = src
           p['dest'] = dest
@@ -418,7 +757,7 @@ def queryTraceChanges(dateFrom, dateTo):
           p['to_date'] = to_date
       positions.extend(temp)
       
-      temp = item['_source']['baseline']
+      temp = item['_source'].get('baseline', [])
       for p in temp:
           p['src'] = src
           p['dest'] = dest
@@ -428,7 +767,7 @@ def queryTraceChanges(dateFrom, dateTo):
           p['to_date'] = to_date
       baseline.extend(temp)
 
-      temp = item['_source']['alt_paths']
+      temp = item['_source'].get('alt_paths', [])
       for p in temp:
           p['src'] = src
           p['dest'] = dest
@@ -444,15 +783,16 @@ def queryTraceChanges(dateFrom, dateTo):
   altPaths = pd.DataFrame(altPaths)
   
   if len(df) > 0:
-    posDf['pair'] = posDf['src']+' -> '+posDf['dest']
-    df['pair'] = df['src']+' -> '+df['dest']
-    baseline['pair'] = baseline['src']+' -> '+baseline['dest']
-    altPaths['pair'] = altPaths['src']+' -> '+altPaths['dest']
+    # the details not requested are empty
+    for frame in [df, posDf, baseline, altPaths]:
+      if len(frame) > 0:
+        frame['pair'] = frame['src']+' -> '+frame['dest']
 
   return df, posDf, baseline, altPaths
 
 
-def query4Avg(idx, dateFrom, dateTo):
+# binSize (ms) returns the averages per time bin instead of over the whole period
+def query4Avg(idx, dateFrom, dateTo, binSize=None):
   # TODO: stick to 1 date format
   # dateFrom = convertDate(dateFrom)
   # dateTo = convertDate(dateTo)
@@ -545,17 +885,69 @@ def query4Avg(idx, dateFrom, dateTo):
             }
           }
 
-  aggrs = []
+  if binSize:
+    addTimeBins(query, dateFrom, dateTo, binSize)
+
+  keys = ['src', 'dest', 'src_host', 'dest_host', 'src_site', 'dest_site']
+  df = decodeAvgBuckets(compositePages(idx, query), keys, val_fld, dateFrom, dateTo, binSize)
+  df['pair'] = df['src'] + '-' + df['dest']
+
+  return upperCase(df)[['pair'] + keys + ['value', 'from', 'to', 'doc_count']]
+
+
+# the fields of the raw throughput measurements shown by the throughput page
+THROUGHPUT_FIELDS = ['timestamp', 'src', 'dest', 'throughput', 'retransmits', 'src_host', 'dest_host',
+                     'src_site', 'src_netsite', 'src_rcsite', 'dest_site', 'dest_netsite', 'dest_rcsite',
+                     'src_production', 'dest_production']
+
+
+# the raw throughput measurements between the two lists of IPs
+def queryThroughputRaw(sips, dips, ipv6, dateFrom, dateTo, slices=2):
+  q = {
+      "_source": THROUGHPUT_FIELDS,
+      "query" : {
+          "bool" : {
+          "must" : [
+                {
+                  "range": {
+                      "timestamp": {
+                      "gte": dateFrom,
+                      "lte": dateTo,
+                      "format": "epoch_millis"
+                      }
+                    }
+                },
+                {
+                  "terms" : {
+                    "src": sips
+                  }
+                },
+                {
+                  "terms" : {
+                    "dest": dips
+                  }
+                },
+                {
+                  "term": {
+                      "ipv6": {
+                        "value": ipv6
+                      }
+                  }
+                }
+            ]
+          }
+        }
+      }
+  # print(str(q).replace("\'", "\""))
+
+  result = slicedScan('ps_throughput', q, slices)
+  data = []
+
+  for item in result:
+      data.append(item['_source'])
 
-  aggdata = hp.es.search(index=idx, body=query, _source=False)
-  for item in aggdata['aggregations']['groupby']['buckets']:
-      aggrs.append({'pair': str(item['key']['src']+'-'+item['key']['dest']),
-                    'src': item['key']['src'], 'dest': item['key']['dest'],
-                    'src_host': item['key']['src_host'], 'dest_host': item['key']['dest_host'],
-                    'src_site': item['key']['src_site'], 'dest_site': item['key']['dest_site'],
-                    'value': item[val_fld]['value'],
-                    'from': dateFrom, 'to': dateTo,
-                    'doc_count': item['doc_count']
-                    })
+  df = pd.DataFrame(data)
 
-  return aggrs
\ No newline at end of file
+  df['pair'] = df['src']+'->'+df['dest']
+  df['dt'] = df['timestamp']
+  return df
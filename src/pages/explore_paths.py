@@ -9,6 +9,7 @@ import plotly.graph_objects as go
 import utils.helpers as hp
 import model.queries as qrs
 from model.Alarms import Alarms
+from model.ASNOwners import asnOwners
 from utils.parquet import Parquet
 
 
@@ -134,7 +135,7 @@ def update_output(asn, asnState, sites, sitesState):
 
 
     df =  pivotFrames['path changed between sites']
-    scntdf = df[df['tag'] != ''].groupby('tag')[['id']].count().reset_index().rename(columns={'id': 'cnt', 'tag': 'site'})
+    scntdf = df[df['tag'] != ''].groupby('tag', observed=True)[['id']].count().reset_index().rename(columns={'id': 'cnt', 'tag': 'site'})
 
     # sites
     graphData = scntdf.copy()
@@ -149,7 +150,7 @@ def update_output(asn, asnState, sites, sitesState):
     for event in sorted(['path changed','path changed between sites']):
         df = pivotFrames[event]
         
-        df = df[df['tag'].isin(sitesState)] if len(sitesState) > 0 else df
+        df = alarmsInst.select(df, tag=sitesState) if len(sitesState) > 0 else df
         if 'diff' in df.columns and len(asnState) > 0:
             df = df[df['diff'].isin(asnState)]
         elif 'asn' in df.columns and len(asnState) > 0:
@@ -170,7 +171,7 @@ def update_output(asn, asnState, sites, sitesState):
 
     # graph
     pq = Parquet()
-    changeDf = pq.readFile('parquet/frames/prev_next_asn')
+    changeDf = pq.readFile('frames/prev_next_asn')
     asnsDropdownData = []
 
     if len(changeDf) == 0:
@@ -243,7 +244,7 @@ def generate_tables(frame, pivotFrames, event, alarmsInst):
 def addNetworkOwners(df, labels):
   asns = list(set(df['jumpedFrom'].unique().tolist() +
               df['diff'].unique().tolist()))
-  owners = qrs.getASNInfo(asns)
+  owners = asnOwners.get(asns)
 
   customdata = []
   for l in labels:
@@ -155,7 +155,7 @@ def get_country_code(country_name):
 
 
 def total_number_of_alarms(sitesDf):
-    metaDf = pq.readFile('parquet/raw/metaDf.parquet')
+    metaDf = pq.readFile('raw/metaDf.parquet')
     sitesDf = pd.merge(sitesDf, metaDf[['lat', 'lon', 'country']], on=['lat', 'lon'], how='left').drop_duplicates()
     site_totals = sitesDf.groupby('site')[['Infrastructure', 'Network', 'Other']].sum()
 
@@ -214,7 +214,7 @@ alarmsInst = Alarms()
 
 def layout(**other_unknown_query_strings):
     dateFrom, dateTo = hp.defaultTimeRange(1)
-    alarmCnt = pq.readFile('parquet/alarmsGrouped.parquet')
+    alarmCnt = pq.readFile('alarmsGrouped.parquet')
     statusTable, sitesDf = generate_status_table(alarmCnt)
     print("Period:", dateFrom," - ", dateTo)
     print(f'Number of alarms: {len(alarmCnt)}')
@@ -7,6 +7,7 @@ from datetime import datetime
 import utils.helpers as hp
 from model.Alarms import Alarms
 import model.queries as qrs
+import model.aqueries as aqrs
 
 import urllib3
 from datetime import datetime
@@ -48,7 +49,12 @@ def obtainFieldNames(dateFrom):
 
 def layout(q=None, **other_unknown_query_strings):
     if q:
-      alarm = qrs.getAlarm(q)
+      pq = Parquet()
+      # the alarm and its category are queried while the metadata is read from the file
+      (alarm, category), metaDf = aqrs.gather(
+          aqrs.getAlarmAndCategory(q),
+          aqrs.inThread(pq.readFile, 'raw/metaDf.parquet')
+      )
       print('URL query:', q)
       print()
       print('Alarm content:', alarm)
@@ -71,9 +77,6 @@ def layout(q=None, **other_unknown_query_strings):
       timeRange = f"(from:'{dates[0]}',to:'{dates[1]}')"
       fieldName = obtainFieldNames(dates[0]) 
 
-      pq = Parquet()
-      metaDf = pq.readFile('parquet/raw/metaDf.parquet')
-
       alarmsInst = Alarms()
       url = f'https://atlas-kibana.mwt2.org:5601/s/networking/app/dashboards?auth_provider_hint=anonymous1#/view/e015c210-65e2-11ed-afcf-d91dad577662?embed=true&_g=(filters%3A!()%2CrefreshInterval%3A(pause%3A!t%2Cvalue%3A0)%2Ctime%3A{timeRange})&show-query-input=true&show-time-filter=true&_a=(query:(language:kuery,query:\'{query}\'))'
       
@@ -120,7 +123,7 @@ def layout(q=None, **other_unknown_query_strings):
                               html.H1(f"Summary", className="text-left"),
                               html.Hr(className="my-2")]),
                             dbc.Row([
-                                html.P(alarmsInst.buildSummary(alarm), className='subtitle'),
+                                html.P(alarmsInst.buildSummary(alarm, category), className='subtitle'),
                               ], justify="start"),
                             ])
                         ],
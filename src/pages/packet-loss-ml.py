@@ -285,9 +285,9 @@ def update_output(start_date, end_date, sensitivity, sitesState):
     # query for the dataset
     if (start_date, end_date) == (start_date_check, end_date_check):
         pq = Parquet()
-        plsDf_onehot = pq.readFile(f'parquet/ml-datasets/packet_loss_onehot_Df.parquet')
+        plsDf_onehot = pq.readFile(f'ml-datasets/packet_loss_onehot_Df.parquet')
 
-        model_pkl_file = f'parquet/ml-datasets/XGB_Classifier_model_packet_loss.pkl'
+        model_pkl_file = pq.path('ml-datasets/XGB_Classifier_model_packet_loss.pkl')
         with open(model_pkl_file, 'rb') as file:
             model = pickle.load(file)
     else:
@@ -14,7 +14,9 @@ from utils.helpers import timer
 
 import utils.helpers as hp
 import model.queries as qrs
+import model.aqueries as aqrs
 from model.Alarms import Alarms
+from model.ASNOwners import asnOwners
 
 import urllib3
 urllib3.disable_warnings()
@@ -62,9 +64,12 @@ def layout(q=None, **other_unknown_query_strings):
         print()
         print('Alarm content:', alarm)
 
-        chdf, posDf, baseline, altPaths = qrs.queryTraceChanges(alarm['from'], alarm['to'])
         dateFrom, dateTo = hp.getPriorNhPeriod(alarm["to"])
-        frames, pivotFrames = alarmsInst.loadData(dateFrom, dateTo)
+        # the trace changes are queried while the alarms are loaded from the files
+        (chdf, posDf, baseline, altPaths), (frames, pivotFrames) = aqrs.gather(
+            aqrs.queryTraceChanges(alarm['from'], alarm['to']),
+            aqrs.inThread(alarmsInst.loadData, dateFrom, dateTo)
+        )
         posDf['asn'] = posDf['asn'].astype(int)
 
         dsts = chdf.groupby('dest_site')[['pair']].count().reset_index().rename(columns={'dest_site':'site'})
@@ -430,7 +435,7 @@ def singlePlotPositions(dd):
 @timer
 def descChange(pair, chdf, posDf):
 
-  owners = qrs.getASNInfo(posDf[(posDf['pair']==pair)]['asn'].values.tolist())
+  owners = asnOwners.get(posDf[(posDf['pair']==pair)]['asn'].values.tolist())
   owners['-1'] = 'OFF/Unavailable'
   howPathChanged = []
   for diff in chdf[(chdf['pair']==pair)]['diff'].values.tolist()[0]:
@@ -444,13 +449,13 @@ def descChange(pair, chdf, posDf):
             if newASN not in [0, -1]:
               if P < 1:
                 howPathChanged.append({'diff': diff,
-                                      'diffOwner': owners[str(diff)], 'atPos': pos,
-                                      'jumpedFrom': newASN, 'jumpedFromOwner': owners[str(newASN)]})
+                                      'diffOwner': owners.get(str(diff), ''), 'atPos': pos,
+                                      'jumpedFrom': newASN, 'jumpedFromOwner': owners.get(str(newASN), '')})
           # the following check is covering the cases when the change happened at the very end of the path
           # i.e. the only ASN that appears at that position is the diff detected
           if len(atPos) == 0:
             howPathChanged.append({'diff': diff,
-                                  'diffOwner': owners[str(diff)], 'atPos': pos,
+                                  'diffOwner': owners.get(str(diff), ''), 'atPos': pos,
                                   'jumpedFrom': "No data", 'jumpedFromOwner': ''})
 
   if len(howPathChanged)>0:
@@ -3,12 +3,12 @@ from dash import Dash, dcc, html, Input, Output, State, Patch, MATCH
 import dash_bootstrap_components as dbc
 import plotly.graph_objects as go
 
-from elasticsearch.helpers import scan
 import pandas as pd
 
 from utils.helpers import timer
 import utils.helpers as hp
 from model.Alarms import Alarms
+from model.ASNOwners import asnOwners
 import model.queries as qrs
 
 import urllib3
@@ -37,97 +37,7 @@ dash.register_page(
 
 @timer
 def getStats(dateFrom, dateTo, site):
-    q = {
-        "query": {
-            "bool": {
-            "must": [
-                {
-                "range": {
-                    "to_date": {
-                    "gte": dateFrom,
-                    "lte": dateTo,
-                    "format": "strict_date_optional_time"
-                    }
-                }
-                },
-                {
-                    "bool": {
-                        "should": [
-                        {
-                            "term": {
-                            "src_site": site
-                            }
-                        },
-                        {
-                            "term": {
-                            "dest_site": site
-                            }
-                        }
-                        ]
-                    }
-                    }
-            ]
-            }
-        }
-        }
-
-    # print(str(q).replace("\'", "\""))
-    result = scan(client=hp.es,index='ps_traces_changes',query=q)
-    data, positions, baseline, altPaths = [],[],[],[]
-    positions = []
-    for item in result:
-
-        tempD = {}
-        for k,v in item['_source'].items():
-            if k not in ['positions', 'baseline', 'alt_paths', 'created_at']:
-                tempD[k] = v
-        data.append(tempD)
-
-        src,dest,src_site,dest_site, = item['_source']['src'], item['_source']['dest'], item['_source']['src_site'], item['_source']['dest_site']
-        from_date,to_date = item['_source']['from_date'], item['_source']['to_date']
-
-        temp = item['_source']['positions']
-        for p in temp:
-            p['src'] = src
-            p['dest'] = dest
-            p['src_site'] = src_site
-            p['dest_site'] = dest_site
-            p['from_date'] = from_date
-            p['to_date'] = to_date
-        positions.extend(temp)
-        
-        temp = item['_source']['baseline']
-        for p in temp:
-            p['src'] = src
-            p['dest'] = dest
-            p['src_site'] = src_site
-            p['dest_site'] = dest_site
-            p['from_date'] = from_date
-            p['to_date'] = to_date
-        baseline.extend(temp)
-
-        temp = item['_source']['alt_paths']
-        for p in temp:
-            p['src'] = src
-            p['dest'] = dest
-            p['src_site'] = src_site
-            p['dest_site'] = dest_site
-            p['from_date'] = from_date
-            p['to_date'] = to_date
-        altPaths.extend(temp)
-
-    df = pd.DataFrame(data)
-    posDf = pd.DataFrame(positions)
-    baseline = pd.DataFrame(baseline)
-    altPaths = pd.DataFrame(altPaths)
-    
-    if len(df)>0:
-      posDf['pair'] = posDf['src']+' -> '+posDf['dest']
-      df['pair'] = df['src']+' -> '+df['dest']
-      baseline['pair'] = baseline['src']+' -> '+baseline['dest']
-      altPaths['pair'] = altPaths['src']+' -> '+altPaths['dest']
-
-    return df, posDf, baseline, altPaths
+    return qrs.querySiteTraceChanges(dateFrom, dateTo, site)
 
 
 
@@ -493,7 +403,7 @@ def singlePlotPositions(dd):
 @timer
 def descChange(pair, chdf, posDf):
 
-  owners = qrs.getASNInfo(posDf[(posDf['pair'] == pair)]['asn'].values.tolist())
+  owners = asnOwners.get(posDf[(posDf['pair'] == pair)]['asn'].values.tolist())
   owners['-1'] = 'OFF/Unavailable'
   howPathChanged = []
   for diff in chdf[(chdf['pair'] == pair)]['diff'].values.tolist()[0]:
@@ -508,13 +418,13 @@ def descChange(pair, chdf, posDf):
             if newASN not in [0, -1]:
               if P < 1:
                 howPathChanged.append({'diff': diff,
-                                      'diffOwner': owners[str(diff)], 'atPos': pos,
-                                       'jumpedFrom': newASN, 'jumpedFromOwner': owners[str(newASN)]})
+                                      'diffOwner': owners.get(str(diff), ''), 'atPos': pos,
+                                       'jumpedFrom': newASN, 'jumpedFromOwner': owners.get(str(newASN), '')})
           # the following check is covering the cases when the change happened at the very end of the path
           # i.e. the only ASN that appears at that position is the diff detected
           if len(atPos) == 0:
             howPathChanged.append({'diff': diff,
-                                  'diffOwner': owners[str(diff)], 'atPos': pos,
+                                  'diffOwner': owners.get(str(diff), ''), 'atPos': pos,
                                    'jumpedFrom': "No data", 'jumpedFromOwner': ''})
 
   if len(howPathChanged) > 0:
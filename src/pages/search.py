@@ -143,7 +143,7 @@ def update_output(start_date, end_date, sites, all, events, allevents, sitesStat
 
     scntdf = pd.DataFrame()
     for e, df in pivotFrames.items():
-        df = df[df['tag'] != ''].groupby('tag')[['id']].count().reset_index().rename(columns={'id': 'cnt', 'tag': 'site'})
+        df = df[df['tag'] != ''].groupby('tag', observed=True)[['id']].count().reset_index().rename(columns={'id': 'cnt', 'tag': 'site'})
         df['event'] = e
         scntdf = pd.concat([scntdf, df])
 
@@ -176,7 +176,7 @@ def update_output(start_date, end_date, sites, all, events, allevents, sitesStat
 
     for event in sorted(events):
         df = pivotFrames[event]
-        df = df[df['tag'].isin(sitesState)] if sitesState is not None and len(sitesState) > 0 else df
+        df = alarmsInst.select(df, tag=sitesState) if sitesState is not None and len(sitesState) > 0 else df
         if len(df) > 0:
             dataTables.append(generate_tables(frames[event], df, event, alarmsInst))
     dataTables = html.Div(dataTables)
@@ -51,7 +51,7 @@ def generate_tables(site, dateFrom, dateTo, frames, pivotFrames, alarms4Site, al
             for event in sorted(alarms4Site['event'].unique()):
                 eventDf = pivotFrames[event]
                 # find all cases where selected site was pinned in tag field
-                ids = eventDf[(eventDf['tag'] == site) & ((eventDf['to'] >= dateFrom) & (eventDf['to'] <= dateTo))]['id'].values
+                ids = alarmsInst.select(eventDf, dateFrom, dateTo, tag=site)['id'].values
 
                 tagsDf = frames[event]
                 dfr = tagsDf[tagsDf.index.isin(ids)]
@@ -101,12 +101,12 @@ def generate_tables(site, dateFrom, dateTo, frames, pivotFrames, alarms4Site, al
 
 @lru_cache(maxsize=None)
 def loadAllTests(pq):
-    measures = pq.readFile('parquet/raw/measures.parquet')
+    measures = pq.readSequenceOfFiles('raw/measures/', 'idx=*/window=')
     return measures
 
 
 def SitesOverviewPlots(site_name, pq):
-    metaDf = pq.readFile('parquet/raw/metaDf.parquet')
+    metaDf = pq.readFile('raw/metaDf.parquet')
 
     alltests = loadAllTests(pq)
 
@@ -261,7 +261,7 @@ def layout(q=None, **other_unknown_query_strings):
   dateFrom, dateTo = hp.defaultTimeRange(1)
   frames, pivotFrames = alarmsInst.loadData(dateFrom, dateTo)
 
-  alarmCnt = pq.readFile('parquet/alarmsGrouped.parquet')
+  alarmCnt = pq.readFile('alarmsGrouped.parquet')
   alarmCnt = alarmCnt[alarmCnt['site'] == q]
 
   if q:
@@ -290,10 +290,10 @@ def update_output(start_date, end_date, sensitivity, sitesState):
     # query for the dataset
     if (start_date, end_date) == (start_date_check, end_date_check):
         pq = Parquet()
-        # rawDf = pq.readFile('parquet/ml-datasets/throughput_Df.parquet')
-        rawDf_onehot = pq.readFile('parquet/ml-datasets/throughput_onehot_Df.parquet')
+        # rawDf = pq.readFile('ml-datasets/throughput_Df.parquet')
+        rawDf_onehot = pq.readFile('ml-datasets/throughput_onehot_Df.parquet')
 
-        model_pkl_file = f'parquet/ml-datasets/XGB_Classifier_model_throughput.pkl'
+        model_pkl_file = pq.path('ml-datasets/XGB_Classifier_model_throughput.pkl')
         with open(model_pkl_file, 'rb') as file:
             model = pickle.load(file)
     else:
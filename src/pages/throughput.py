@@ -5,8 +5,6 @@ from dash.dependencies import Input, Output, MATCH, State
 import plotly.graph_objects as go
 import plotly.express as px
 
-from elasticsearch.helpers import scan
-
 import pandas as pd
 from datetime import datetime
 import requests
@@ -18,6 +16,7 @@ import utils.helpers as hp
 from utils.helpers import timer
 from model.Alarms import Alarms
 import model.queries as qrs
+import model.aqueries as aqrs
 from utils.parquet import Parquet
 
 
@@ -48,65 +47,17 @@ def convertTime(ts):
     return int((stripped - datetime(1970, 1, 1)).total_seconds()*1000)
 
 
-# TODO: move that query to queries.py
 @timer
 def getRawDataFromES(src, dest, ipv6, dateFrom, dateTo):
     pq = Parquet()
-    metaDf = pq.readFile('parquet/raw/metaDf.parquet')
+    metaDf = pq.readFile('raw/metaDf.parquet')
     sips = metaDf[(metaDf['site'] == src) | (metaDf['netsite'] == src)]['ip'].values.tolist()
     sips = [ip.upper() for ip in sips] + [ip.lower() for ip in sips]
     dips = metaDf[(metaDf['site'] == dest) | (metaDf['netsite'] == dest)]['ip'].values.tolist()
     dips = [ip.upper() for ip in dips] + [ip.lower() for ip in dips]
 
     if len(sips) > 0 or len(dips) > 0:
-      q = {
-          "query" : {  
-              "bool" : {
-              "must" : [
-                    {
-                      "range": {
-                          "timestamp": {
-                          "gte": convertTime(dateFrom),
-                          "lte": convertTime(dateTo),
-                          "format": "epoch_millis"
-                          }
-                        }
-                    },
-                    {
-                      "terms" : {
-                        "src": sips
-                      }
-                    },
-                    {
-                      "terms" : {
-                        "dest": dips
-                      }
-                    },
-                    {
-                      "term": {
-                          "ipv6": {
-                            "value": ipv6
-                          }
-                      }
-                    }
-                ]
-              }
-            }
-          }
-      # print(str(q).replace("\'", "\""))
-
-      result = scan(client=hp.es,index='ps_throughput',query=q)
-      data = []
-
-      for item in result:
-          data.append(item['_source'])
-
-      df = pd.DataFrame(data)
-
-      df['pair'] = df['src']+'->'+df['dest']
-      df['dt'] = df['timestamp']
-      return df
-
+      return qrs.queryThroughputRaw(sips, dips, ipv6, convertTime(dateFrom), convertTime(dateTo))
     else: print(f'No IPs found for the selected sites {src} and {dest} {ipv6}')
     
 
@@ -172,7 +123,11 @@ def layout(q=None, **other_unknown_query_strings):
     alarmData = alarm['source']
     dateFrom, dateTo = hp.getPriorNhPeriod(alarmData['to'])
     print('Alarm\'s content:', alarmData)
-    pivotFrames = alarmsInst.loadData(dateFrom, dateTo)[1]
+    # the category is queried while the alarms are loaded from the files
+    category, (frames, pivotFrames) = aqrs.gather(
+        aqrs.getCategory(alarm['event']),
+        aqrs.inThread(alarmsInst.loadData, dateFrom, dateTo)
+    )
 
     data = alarmsInst.getOtherAlarms(
                                     currEvent=alarm['event'],
@@ -213,7 +168,7 @@ def layout(q=None, **other_unknown_query_strings):
                             html.H1(f"Summary", className="text-left"),
                             html.Hr(className="my-2")]),
                           dbc.Row([
-                              html.P(alarmsInst.buildSummary(alarm), className='subtitle'),
+                              html.P(alarmsInst.buildSummary(alarm, category), className='subtitle'),
                             ], justify="start"),
                           ])
                       ],
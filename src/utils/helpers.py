@@ -6,36 +6,131 @@ import requests
 import os
 import pandas as pd
 import functools
+import threading
 
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, AsyncElasticsearch
 import getpass
 
+from utils.replay import ReplayES, AsyncReplayES
+
 
 INDICES = ['ps_packetloss', 'ps_owd', 'ps_throughput', 'ps_trace']
 
 user, passwd, mapboxtoken = None, None, None
-with open("/etc/ps-dash/creds.key") as f:
-    user = f.readline().strip()
-    passwd = f.readline().strip()
-    mapboxtoken = f.readline().strip()
 
-def ConnectES():
-    global user, passwd
-    credentials = (user, passwd)
+def readCredentials():
+    global user, passwd, mapboxtoken
+    if user is None:
+        with open("/etc/ps-dash/creds.key") as f:
+            user = f.readline().strip()
+            passwd = f.readline().strip()
+            mapboxtoken = f.readline().strip()
+    return user, passwd
+
+
+# The ES client is created on first use instead of at import, and again in a forked
+# process (e.g. a gunicorn worker), so that the processes never share its sockets.
+# The settings can be changed through the environment:
+#   PS_DASH_ES_HOSTS      comma-separated urls used instead of the default cluster
+#   PS_DASH_ES_POOL       connections kept open per node (10)
+#   PS_DASH_ES_KEEPALIVE  0 closes the connection after each request (1)
+#   PS_DASH_ES_TIMEOUT    default request timeout in seconds (240)
+#   PS_DASH_ES_RETRIES    max retries of a request (10)
+#   PS_DASH_ES_PING       1 checks the connection when the client is created (0)
+# and without the cluster, through the recorded responses of utils.replay:
+#   PS_DASH_ES_REPLAY          folder of the recordings
+#   PS_DASH_ES_REPLAY_MODE     "record" saves the responses of the cluster, "replay" serves them (replay)
+#   PS_DASH_ES_REPLAY_LATENCY  delay in seconds added to each replayed request (0)
+# The time ranges of the recorded requests are fixed with PS_DASH_NOW (see now)
+def esSettings():
+    env = os.environ
+    settings = {
+        'basic_auth': readCredentials(),
+        'connections_per_node': int(env.get('PS_DASH_ES_POOL', 10)),
+        'request_timeout': float(env.get('PS_DASH_ES_TIMEOUT', 240)),
+        'max_retries': int(env.get('PS_DASH_ES_RETRIES', 10)),
+    }
+    if env.get('PS_DASH_ES_KEEPALIVE', '1') == '0':
+        settings['headers'] = {'Connection': 'close'}
+
+    if env.get('PS_DASH_ES_HOSTS'):
+        hosts = env['PS_DASH_ES_HOSTS'].split(',')
+    elif getpass.getuser() == 'petya':
+        hosts = 'https://localhost:9200'
+        settings.update({'verify_certs': False, 'request_timeout': 200, 'max_retries': 20})
+    else:
+        hosts = [{'host': 'atlas-kibana.mwt2.org', 'port': 9200, 'scheme': 'https'}]
+    return hosts, settings
+
 
+# the replay client wraps the real one when recording, the cluster is not needed to replay
+def replaySettings():
+    env = os.environ
+    mode = env.get('PS_DASH_ES_REPLAY_MODE', 'replay')
+    return env.get('PS_DASH_ES_REPLAY'), mode, float(env.get('PS_DASH_ES_REPLAY_LATENCY', 0))
+
+
+def ConnectES():
     try:
-        if getpass.getuser() == 'petya':
-            es = Elasticsearch('https://localhost:9200', verify_certs=False, timeout=200, http_auth=credentials, max_retries=20)
+        location, mode, latency = replaySettings()
+        if location and mode == 'replay':
+            es = ReplayES(location, latency=latency)
         else:
-            es = Elasticsearch([{'host': 'atlas-kibana.mwt2.org', 'port': 9200, 'scheme': 'https'}],
-                                timeout=240, http_auth=credentials, max_retries=10)
-        print('Success' if es.ping()==True else 'Fail')
+            hosts, settings = esSettings()
+            es = Elasticsearch(hosts, **settings)
+            if location:
+                es = ReplayES(location, mode, es)
+
+        if os.environ.get('PS_DASH_ES_PING', '0') == '1':
+            print('Success' if es.ping()==True else 'Fail')
         return es
     except Exception as error:
         print (">>>>>> Elasticsearch Client Error:", error)
 
 
 
+# The async client is used by model.aqueries on its own event loop
+def ConnectAsyncES():
+    try:
+        location, mode, latency = replaySettings()
+        if location and mode == 'replay':
+            return AsyncReplayES(location, latency=latency)
+
+        hosts, settings = esSettings()
+        es = AsyncElasticsearch(hosts, **settings)
+        return AsyncReplayES(location, mode, es) if location else es
+    except Exception as error:
+        print (">>>>>> Elasticsearch Client Error:", error)
+
+
+_es = None
+_esLock = threading.Lock()
+
+def _resetES():
+    global _es, _esLock
+    _es, _esLock = None, threading.Lock()
+
+os.register_at_fork(after_in_child=_resetES)
+
+
+# timeout (in seconds) applies to the requests of a single call, e.g. getES(timeout=30).search(...)
+def getES(timeout=None):
+    global _es
+    if _es is None:
+        with _esLock:
+            if _es is None:
+                _es = ConnectES()
+    return _es.options(request_timeout=timeout) if timeout else _es
+
+
+# hp.es is resolved on each access
+def __getattr__(name):
+    if name == 'es':
+        return getES()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+
 def timer(func):
     @functools.wraps(func)
     def wrapper_timer(*args, **kwargs):
@@ -69,12 +164,26 @@ def getValueUnit(test_type):
         return 'delay (ms) avg'
 
 
+# The current time in seconds since epoch. PS_DASH_NOW (a UTC date, e.g. 2024-05-01T12:00:00)
+# freezes it, so that the default periods and the windows of the updater do not move,
+# e.g. to replay the responses recorded at that time (see utils.replay)
+def now():
+    frozen = os.environ.get('PS_DASH_NOW')
+    if frozen:
+        return pd.Timestamp(frozen).timestamp()
+    return time.time()
+
+
+def utcNow():
+    return datetime.utcfromtimestamp(now())
+
+
 def defaultTimeRange(days=3, datesOnly=False):
     format = '%Y-%m-%dT%H:%M:%S.000Z'
     if datesOnly:
         format = '%Y-%m-%d'
     
-    now = roundTime(datetime.utcnow())  # 1 hour
+    now = roundTime(utcNow())  # 1 hour
     defaultEnd = datetime.strftime(now, format)
     defaultStart = datetime.strftime(now - timedelta(days), format)
 
@@ -83,7 +192,7 @@ def defaultTimeRange(days=3, datesOnly=False):
 
 def roundTime(dt=None, round_to=60*60):
     if dt == None:
-        dt = datetime.utcnow()
+        dt = utcNow()
     seconds = (dt - dt.min).seconds
     rounding = (seconds+round_to/2) // round_to * round_to
     return dt + timedelta(0,rounding-seconds,-dt.microsecond)
@@ -205,5 +314,3 @@ def LoadPSConfigData(idx_host_list, dateFrom, dateTo):
     
     print("LoadPSConfigData took: %ss" % (int(time.time() - start)))
     return dest_df
-
-es = ConnectES()
\ No newline at end of file
@@ -1,31 +1,186 @@
+import os
+import json
+import time
+import shutil
+import threading
+import fcntl
+from contextlib import contextmanager
+
 import pyarrow as pa
 import pyarrow.parquet as pq
 import dask.dataframe as dd
 import traceback
 import glob
 import pandas as pd
+from flask import g, has_request_context
+
+
+# The cached data is published as versioned snapshots:
+#   parquet/snapshots/<version>/...   the files of each version
+#   parquet/CURRENT                   the name of the version readers should use
+# A refresh writes into a new version (a hard-linked copy of the current one)
+# and then replaces CURRENT atomically, so the readers never see partial updates
+LOCATION = 'parquet/'
+SNAPSHOTS = f'{LOCATION}snapshots/'
+CURRENT = f'{LOCATION}CURRENT'
+# describes when and from what period each artifact of a snapshot was produced
+MANIFEST = 'manifest.json'
+# older versions are kept for a while for the requests still pinned to them
+KEEP_VERSIONS = 5
+
+publishLock = threading.Lock()
+
 
 class Parquet(object):
-    
-    @staticmethod
-    def writeToFile(df, filename):
-        table = pa.Table.from_pandas(df, preserve_index=True)
-        pq.write_table(table, filename)
+
+    # root is set for a fixed location (e.g. a snapshot being published),
+    # otherwise the files are read from the current snapshot
+    def __init__(self, root=None):
+        self._root = root
 
     @staticmethod
-    def readSequenceOfFiles(location, prefix):
+    def readCurrent():
+        try:
+            with open(CURRENT) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def version(cls):
+        # Pin one version per request: all reads done while serving a request
+        # come from the same snapshot, even if a new one gets published meanwhile
+        if has_request_context():
+            if 'snapshotVersion' not in g:
+                g.snapshotVersion = cls.readCurrent()
+            return g.snapshotVersion
+        return cls.readCurrent()
+
+    def root(self):
+        if self._root is not None:
+            return self._root
+        version = self.version()
+        # nothing is published yet, all reads will return empty results
+        return f'{SNAPSHOTS}{version if version else "empty"}/'
+
+    def path(self, name):
+        return os.path.join(self.root(), name)
+
+    def glob(self, pattern):
+        root = self.root()
+        return sorted(os.path.relpath(f, root) for f in glob.glob(os.path.join(root, pattern)))
+
+    # the types of the columns are inferred, unless a schema is given
+    def writeToFile(self, df, filename, schema=None):
+        table = pa.Table.from_pandas(df, schema=schema, preserve_index=True)
+        pq.write_table(table, self.newFile(filename))
+
+    # Returns the path of a file to be (re)written. The files in a snapshot
+    # are hard links shared with the previous versions, so they are unlinked
+    # first instead of being overwritten in place
+    def newFile(self, name):
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.lexists(path):
+            os.remove(path)
+        return path
+
+    # moves a file prepared outside of the snapshot into it
+    def importFile(self, source, name):
+        os.replace(source, self.newFile(name))
+
+    def removeFile(self, name):
+        if os.path.lexists(self.path(name)):
+            os.remove(self.path(name))
+
+    # the number of rows is read from the footers, without loading the data
+    def countRows(self, names):
+        return sum(pq.ParquetFile(self.path(name)).metadata.num_rows for name in names)
+
+    def manifest(self):
         try:
-            files = glob.glob(f"{location}{prefix}*")
-            return dd.read_parquet(files).compute()
+            with open(self.path(MANIFEST)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    # records the time the artifact was produced, its size and the period it covers
+    def record(self, artifact, rows, dateFrom=None, dateTo=None):
+        manifest = self.manifest()
+        manifest[artifact] = {'producedAt': int(time.time()), 'rows': int(rows),
+                              'dateFrom': dateFrom, 'dateTo': dateTo}
+        with open(self.newFile(MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    def isStale(self, artifact, maxAge):
+        entry = self.manifest().get(artifact)
+        return entry is None or time.time() - entry['producedAt'] > maxAge
+
+    # The files hold all their columns, the key=value folders (e.g. idx=<index>
+    # of the measures) are not read as partition columns
+    def readSequenceOfFiles(self, location, prefix):
+        try:
+            files = glob.glob(self.path(f"{location}{prefix}*"))
+            return dd.read_parquet(files, dataset={'partitioning': None}).compute()
         except Exception as e:
             print(traceback.format_exc())
-    
-    @staticmethod
-    def readFile(filename):
+
+    def readFile(self, filename):
         try:
-            return dd.read_parquet(filename).compute()
+            return dd.read_parquet(self.path(filename)).compute()
         except FileNotFoundError:
             print(f"{filename} not found.")
             return dd.from_pandas(pd.DataFrame())
         except Exception as e:
             print(traceback.format_exc())
+
+    @contextmanager
+    def publish(self):
+        # The threading lock serializes the jobs of a process, the file lock
+        # protects against another process (e.g. a worker) publishing at the same time
+        with publishLock:
+            os.makedirs(SNAPSHOTS, exist_ok=True)
+            with open(f'{LOCATION}.lock', 'w') as lockFile:
+                fcntl.flock(lockFile, fcntl.LOCK_EX)
+                try:
+                    base = self.readCurrent()
+                    version = str(time.time_ns())
+                    tmp = f'{SNAPSHOTS}.tmp-{version}/'
+                    self.cloneSnapshot(f'{SNAPSHOTS}{base}/' if base else None, tmp)
+
+                    try:
+                        yield Parquet(tmp)
+                    except Exception:
+                        shutil.rmtree(tmp, ignore_errors=True)
+                        raise
+
+                    os.rename(tmp, f'{SNAPSHOTS}{version}')
+                    with open(f'{CURRENT}.tmp', 'w') as f:
+                        f.write(version)
+                    os.replace(f'{CURRENT}.tmp', CURRENT)
+                    print(f'Published snapshot {version}')
+
+                    self.removeOldSnapshots(version)
+                finally:
+                    fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    @staticmethod
+    def cloneSnapshot(source, target):
+        os.makedirs(target)
+        if source and os.path.isdir(source):
+            for path, dirs, files in os.walk(source):
+                folder = os.path.join(target, os.path.relpath(path, source))
+                os.makedirs(folder, exist_ok=True)
+                for f in files:
+                    os.link(os.path.join(path, f), os.path.join(folder, f))
+
+    @staticmethod
+    def removeOldSnapshots(current):
+        versions = sorted((v for v in os.listdir(SNAPSHOTS) if v.isdigit()), key=int)
+        for v in versions[:-KEEP_VERSIONS]:
+            if v != current:
+                shutil.rmtree(f'{SNAPSHOTS}{v}', ignore_errors=True)
+        # leftovers of publications interrupted by a crash
+        for v in os.listdir(SNAPSHOTS):
+            if v.startswith('.tmp-'):
+                shutil.rmtree(f'{SNAPSHOTS}{v}', ignore_errors=True)
@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+
+
+# Stands in for the ES client (hp.es or the async client of model.aqueries), so that the
+# updater, the alarms and the pages can be run and measured without the cluster:
+#   record  the requests are sent to the real client and the responses are saved in location
+#   replay  the saved responses are returned, after an optional delay (in seconds) per request
+# Each response is stored in <location>/<hash of the request>.json. The scroll ids are replaced
+# by ids derived from the initial search, so the scans are replayed page by page
+class ReplayES(object):
+
+    def __init__(self, location, mode='replay', client=None, latency=0):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f'Unknown replay mode {mode!r}')
+        if mode == 'record' and client is None:
+            raise ValueError('Recording needs a client')
+
+        self.location = location
+        self.mode = mode
+        self.client = client
+        self.latency = latency
+        # recorded scroll id -> scroll id of the cluster
+        self.scrolls = {}
+        self.lock = threading.Lock()
+        os.makedirs(location, exist_ok=True)
+
+    # the helpers (e.g. scan) set per-request options, they do not change the responses
+    def options(self, **kwargs):
+        return self
+
+    def requestKey(self, method, params):
+        request = json.dumps({'method': method, **params}, sort_keys=True, default=str)
+        return hashlib.sha1(request.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.location, f'{key}.json')
+
+    def load(self, key, method, params):
+        try:
+            with open(self.path(key)) as f:
+                return json.load(f)['response']
+        except FileNotFoundError:
+            raise LookupError(f'No recorded response for {method} {params.get("index", "")}') from None
+
+    def save(self, method, params, response):
+        key = self.requestKey(method, params)
+        # the 8.x client wraps the body
+        response = self.nextScroll(key, getattr(response, 'body', response))
+        tmp = f'{self.path(key)}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'request': {'method': method, **params}, 'response': response}, f, default=str)
+        os.replace(tmp, self.path(key))
+        return response
+
+    # the scroll id of the page after the one stored under key
+    def nextScroll(self, key, response):
+        realId = response.get('_scroll_id') if isinstance(response, dict) else None
+        if not realId:
+            return response
+        scrollId = f'replay-{key}'
+        with self.lock:
+            self.scrolls[scrollId] = realId
+        return {**response, '_scroll_id': scrollId}
+
+    def realScroll(self, scrollId):
+        with self.lock:
+            return self.scrolls.pop(scrollId, scrollId)
+
+    def replay(self, method, params):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.load(self.requestKey(method, params), method, params)
+
+    def search(self, **params):
+        if self.mode == 'replay':
+            return self.replay('search', params)
+        return self.save('search', params, self.client.search(**params))
+
+    def scroll(self, scroll_id, **params):
+        params = {'scroll_id': scroll_id, **params}
+        if self.mode == 'replay':
+            return self.replay('scroll', params)
+        response = self.client.scroll(**{**params, 'scroll_id': self.realScroll(scroll_id)})
+        return self.save('scroll', params, response)
+
+    def clear_scroll(self, scroll_id=None, **params):
+        if self.mode == 'record' and scroll_id:
+            self.client.options(ignore_status=404).clear_scroll(scroll_id=self.realScroll(scroll_id), **params)
+        return {'succeeded': True}
+
+    def ping(self, **params):
+        if self.mode == 'replay':
+            return self.replay('ping', params)
+        return self.save('ping', params, self.client.ping(**params))
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+
+
+# The same for the async client, the recordings are shared with ReplayES
+class AsyncReplayES(ReplayES):
+
+    async def replay(self, method, params):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.load(self.requestKey(method, params), method, params)
+
+    async def search(self, **params):
+        if self.mode == 'replay':
+            return await self.replay('search', params)
+        return self.save('search', params, await self.client.search(**params))
+
+    async def scroll(self, scroll_id, **params):
+        params = {'scroll_id': scroll_id, **params}
+        if self.mode == 'replay':
+            return await self.replay('scroll', params)
+        response = await self.client.scroll(**{**params, 'scroll_id': self.realScroll(scroll_id)})
+        return self.save('scroll', params, response)
+
+    async def clear_scroll(self, scroll_id=None, **params):
+        if self.mode == 'record' and scroll_id:
+            await self.client.options(ignore_status=404).clear_scroll(scroll_id=self.realScroll(scroll_id), **params)
+        return {'succeeded': True}
+
+    async def ping(self, **params):
+        if self.mode == 'replay':
+            return await self.replay('ping', params)
+        return self.save('ping', params, await self.client.ping(**params))
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()